@@ -0,0 +1,226 @@
+"""
+    Benchmarks for the utils hot paths on synthetic data, reporting time and peak memory at several scales.
+
+    From the repo root:
+        python -m benchmarks.run                              # 1k and 10k rows, compared against the saved baselines
+        python -m benchmarks.run --scales 1000 10000 100000 1000000
+        python -m benchmarks.run --save-baseline              # record the current numbers as the new baselines
+        python -m benchmarks.run --check                      # only the FetchEngine behaviour checks
+    Exits with status 1 if a benchmark got slower than --tolerance times its baseline, or a check failed.
+
+    The registry benchmarks and checks never hit the real CCFS registry. The stub registry one skips the network
+    altogether, the local registry one goes through FetchEngine against a StubRegistryServer on localhost.
+
+    baselines.json holds numbers for the default scales (1k and 10k rows), recorded with --save-baseline.
+    Timings depend on the machine, so re-record them on yours before relying on the regression check.
+    Peak memory comes from tracemalloc, which only sees allocations made through Python. Memory allocated by GEOS
+    (shapely) or Arrow isn't counted, so benchmarks in `native_memory` underreport it and are marked with a *.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import geopandas as gp
+import requests
+
+from benchmarks import synthetic
+from utils.geo import clean_districts, DistrictAssigner
+from utils.owners import LookupCompaniesHelper, GroupCompaniesHelper, get_business_search_payload, search_for_business_url
+from utils.ranking import rank_potential_matches
+
+baselines_path = os.path.join(os.path.dirname(__file__), 'baselines.json')
+districts_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'Council_Districts.geojson')
+
+
+def bench_clean_districts(n, workdir):
+    df_districts = gp.read_file(districts_path)
+    df = synthetic.building_points(n, df_districts)
+    assigner = DistrictAssigner(df_districts)
+    return lambda: clean_districts(df, df_districts, assigner)
+
+
+def bench_separate_search_results(n, workdir):
+    results = synthetic.search_results(n)
+    helper = LookupCompaniesHelper(workdir)
+    return lambda: helper._separate_search_results(results)
+
+
+def bench_extract_principals_business(n, workdir):
+    principals_per_business = 5
+    responses = [synthetic.business_details(i, principals_per_business) for i in range(max(1, n // principals_per_business))]
+    helper = GroupCompaniesHelper(workdir, 'unused.csv')
+    return lambda: [helper._extract_principals_business(res, i, f'BUSINESS {i}') for i, res in enumerate(responses)]
+
+
+def bench_rank_potential_matches(n, workdir):
+    results = synthetic.search_results(n)
+    return lambda: rank_potential_matches(results, k=10)
+
+
+def bench_group_companies_by_principals(n, workdir):
+    principals = synthetic.principal_table(n)
+    helper = GroupCompaniesHelper(workdir + os.sep, 'grouped.csv')
+    return lambda: helper.group_companies_by_principals(principals)
+
+
+def bench_company_list_name_matches(n, workdir):
+    results_per_owner = 20
+    owners = synthetic.company_names(max(1, n // results_per_owner))
+    helper = LookupCompaniesHelper(workdir, engine=synthetic.StubRegistryEngine(results_per_owner, max_workers=1))
+    return lambda: helper.get_company_list_name_matches(owners)
+
+
+def bench_company_matches_local_registry(n, workdir):
+    results_per_owner = 20
+    chunks = 4
+    owners = synthetic.company_names(max(chunks, n // results_per_owner))
+    size = -(-len(owners) // chunks)
+
+    def run():
+        # Every call exports to a fresh folder, otherwise the second call would resume the first one and do nothing
+        out = tempfile.mkdtemp(dir=workdir)
+        with synthetic.StubRegistryServer(results_per_owner, latency=0.002) as server, \
+                synthetic.LocalRegistryEngine(server.url, max_workers=8, rate=2000) as engine, \
+                contextlib.redirect_stdout(io.StringIO()):
+            helper = LookupCompaniesHelper(out, engine=engine)
+            for x, i in enumerate(range(0, len(owners), size)):
+                helper.get_company_matches_and_export(owners[i:i + size], x)
+    return run
+
+
+benchmarks = {
+    'clean_districts': bench_clean_districts,
+    '_separate_search_results': bench_separate_search_results,
+    '_extract_principals_business': bench_extract_principals_business,
+    'rank_potential_matches': bench_rank_potential_matches,
+    'group_companies_by_principals': bench_group_companies_by_principals,
+    'get_company_list_name_matches (stub registry)': bench_company_list_name_matches,
+    'get_company_matches_and_export (local registry)': bench_company_matches_local_registry,
+}
+
+
+# Benchmarks doing most of their allocation outside of Python, see the note at the top
+native_memory = {'clean_districts'}
+
+
+def _search(engine, name):
+    return engine.post_json(search_for_business_url, data=get_business_search_payload(name, 100, 1))
+
+
+def check_fetch_engine() -> list:
+    """
+        Checks FetchEngine against a StubRegistryServer: results come back in order even when responses don't,
+        the rate limit holds across workers, and a search that keeps failing raises requests.HTTPError once the
+        retries run out. Returns the names of the failed checks.
+    """
+    failed = []
+
+    def check(name, ok):
+        print(f"{name:<48}{'ok' if ok else 'FAILED':>10}")
+        if not ok:
+            failed.append(name)
+
+    down = 'ALWAYS DOWN LLC'
+    with synthetic.StubRegistryServer(latency=0.01, failing={down}) as server:
+        names = synthetic.company_names(40)
+        with synthetic.LocalRegistryEngine(server.url, max_workers=8) as engine:
+            found = engine.map(lambda name: _search(engine, name)[0]['BusinessName'], names)
+        check('map keeps the order of the items', found == names)
+
+        rate = 20
+        with synthetic.LocalRegistryEngine(server.url, max_workers=8, rate=rate, burst=1) as engine:
+            start = time.perf_counter()
+            engine.map(lambda name: _search(engine, name), names[:rate + 1])
+            seconds = time.perf_counter() - start
+        # The first request goes out right away, the other `rate` wait for a token each
+        check(f'rate={rate} takes at least 1s for {rate + 1} requests', seconds >= 0.95)
+
+        retries = 2
+        with synthetic.LocalRegistryEngine(server.url, retries=retries, backoff=0.01) as engine:
+            try:
+                _search(engine, down)
+                raised = None
+            except requests.HTTPError as e:
+                raised = e.response.status_code
+        check('HTTPError once the retries run out', raised == 503 and server.requests[down] == retries + 1)
+    return failed
+
+
+def measure(setup, n, memory=True):
+    """ Returns (seconds, peak MB) of one call of the benchmark, setup (data generation) isn't measured. """
+    with tempfile.TemporaryDirectory() as workdir:
+        fn = setup(n, workdir)
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        peak = None
+        if memory:
+            # Measured on a separate call, tracemalloc slows everything down
+            tracemalloc.start()
+            fn()
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--only', nargs='+', choices=list(benchmarks), help='only run these benchmarks')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory")
+    parser.add_argument('--save-baseline', action='store_true', help=f'save the results to {baselines_path}')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='slowdown vs. baseline counted as a regression')
+    parser.add_argument('--check', action='store_true', help='only run the FetchEngine behaviour checks')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        failed = check_fetch_engine()
+        if failed:
+            print(f"{len(failed)} check(s) failed: {', '.join(failed)}")
+            return 1
+        return 0
+
+    baselines = {}
+    if os.path.exists(baselines_path):
+        with open(baselines_path) as f:
+            baselines = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<48}{'rows':>10}{'seconds':>10}{'peak MB':>10}{'baseline':>10}")
+    for name in args.only or benchmarks:
+        for n in args.scales:
+            seconds, peak = measure(benchmarks[name], n, memory=not args.no_memory)
+            key = f'{name}@{n}'
+            results[key] = {'seconds': seconds, 'peak_mb': peak}
+            baseline = baselines.get(key, {}).get('seconds')
+            flag = ''
+            if baseline is not None and seconds > baseline * args.tolerance:
+                regressions.append(key)
+                flag = '  REGRESSION'
+            peak_text = f"{peak if peak is not None else float('nan'):.1f}" + ('*' if name in native_memory else '')
+            print(f"{name:<48}{n:>10}{seconds:>10.3f}{peak_text:>10}"
+                  f"{baseline if baseline is not None else float('nan'):>10.3f}{flag}")
+
+    if not args.no_memory and native_memory.intersection(args.only or benchmarks):
+        print("* most of this benchmark's memory is allocated by GEOS or Arrow, which tracemalloc doesn't see")
+    if args.save_baseline:
+        baselines.update(results)
+        with open(baselines_path, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Saved baselines to {baselines_path}')
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
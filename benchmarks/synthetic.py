@@ -0,0 +1,249 @@
+"""
+    Synthetic data generators for the benchmarks, shaped like the real building, owner search and principals data.
+"""
+
+import json
+import random
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import geopandas as gp
+
+from utils.fetch import FetchEngine
+
+# Spellings of the entity suffixes seen in the owner and business names
+entity_suffixes = ['LLC', 'L.L.C.', 'L L C', 'LLC.', 'LIMITED LIABILITY COMPANY', 'LP', 'L.P.', 'LLP', 'L.L.P.',
+                   'LIMITED PARTNERSHIP', 'INC', 'CORP', '']
+name_words = ['SEATTLE', 'PINE', 'UNION', 'HARBOR', 'FIFTH', 'AVENUE', 'CAPITOL', 'HILL', 'LAKE', 'UNIVERSITY',
+              'DENNY', 'MADISON', 'SOUND', 'VIEW', 'PARK', 'TOWER', 'PLAZA', 'HOLDINGS', 'PROPERTIES', 'INVESTORS',
+              'APARTMENTS', 'OWNER', 'PARTNERS', 'GROUP', 'RAINIER', 'ALKI', 'BALLARD', 'FREMONT', 'QUEEN', 'ANNE']
+first_names = ['JOHN', 'MARY', 'ANNA', 'DAVID', 'LINDA', 'JAMES', 'SUSAN', 'ROBERT', 'KAREN', 'MICHAEL', 'AMY', 'BRIAN']
+last_names = ['SMITH', 'LEE', 'NGUYEN', 'JOHNSON', 'GARCIA', 'KIM', 'BROWN', 'DAVIS', 'LOPEZ', 'WILSON', 'CHEN', 'HALL']
+agents = ['CORPORATION SERVICE COMPANY', 'CT CORPORATION SYSTEM', 'REGISTERED AGENTS INC', 'NATIONAL REGISTERED AGENTS']
+
+
+def _base_names(n, rng):
+    """ `n` distinct-ish company names without suffixes. """
+    words = rng.choice(name_words, size=(n, 3))
+    numbers = rng.integers(1, 3000, size=n)
+    return [f'{num} {a} {b} {c}' for num, (a, b, c) in zip(numbers, words)]
+
+
+def company_names(n: int, seed: int = 0) -> list:
+    """ `n` company names, each with a random spelling of LLC, LP, etc. """
+    rng = np.random.default_rng(seed)
+    suffixes = rng.choice(entity_suffixes, size=n)
+    return [f'{base} {suffix}'.strip() for base, suffix in zip(_base_names(n, rng), suffixes)]
+
+
+def building_points(n: int, df_districts: gp.GeoDataFrame, outside_fraction: float = 0.01, seed: int = 0) -> gp.GeoDataFrame:
+    """
+        `n` buildings with points inside the council district polygons, plus `outside_fraction` of them in the water
+        or otherwise outside every district, like the waterfront buildings clean_districts can't place.
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = df_districts.total_bounds
+    area = df_districts.union_all() if hasattr(df_districts, 'union_all') else df_districts.unary_union
+    n_outside = int(n * outside_fraction)
+
+    inside = []
+    needed = n - n_outside
+    while needed > 0:
+        # Rejection sampling in batches, the districts cover a bit over half of their bounding box
+        candidates = gp.GeoSeries(gp.points_from_xy(rng.uniform(minx, maxx, 2 * needed),
+                                                    rng.uniform(miny, maxy, 2 * needed)), crs=df_districts.crs)
+        kept = candidates[candidates.within(area)][:needed]
+        inside.append(kept)
+        needed -= len(kept)
+    outside = gp.GeoSeries(gp.points_from_xy(rng.uniform(maxx + 0.01, maxx + 0.1, n_outside),
+                                             rng.uniform(miny, maxy, n_outside)), crs=df_districts.crs)
+    geometry = pd.concat(inside + [outside], ignore_index=True)
+
+    return gp.GeoDataFrame({
+        'BuildingName': [f'BUILDING {i}' for i in range(n)],
+        'TaxParcelIdentificationNumber': rng.integers(10**9, 10**10, size=n),
+    }, geometry=geometry.to_numpy(), crs=df_districts.crs)
+
+
+def search_results(n_rows: int, results_per_owner: int = 20, exact_rate: float = 0.6, seed: int = 0) -> pd.DataFrame:
+    """
+        Owner search results like LookupCompaniesHelper._get_potential_company_name_matches returns, `n_rows` in total.
+        About `exact_rate` of the owners have a result that matches them exactly once normalized.
+    """
+    rng = np.random.default_rng(seed)
+    n_owners = max(1, n_rows // results_per_owner)
+    owners = np.array(company_names(n_owners, seed))
+    owner_idx = np.repeat(np.arange(n_owners), results_per_owner)[:n_rows]
+    names = np.array(company_names(n_rows, seed + 1), dtype=object)
+
+    # First result of an owner with an exact match is the owner's name spelled with a different suffix
+    first = np.r_[True, owner_idx[1:] != owner_idx[:-1]]
+    exact = first & (rng.random(n_rows) < exact_rate)
+    names[exact] = [o.replace('L.L.C.', 'LLC').replace('LIMITED PARTNERSHIP', 'LLC') for o in owners[owner_idx[exact]]]
+
+    return pd.DataFrame({
+        'SearchTerm': owners[owner_idx],
+        'BusinessName': names,
+        'UBINumber': [f'{u // 10**6} {u // 10**3 % 1000:03d} {u % 1000:03d}' for u in rng.integers(6 * 10**8, 7 * 10**8, n_rows)],
+        'BusinessId': rng.integers(10**5, 2 * 10**6, n_rows),
+        'Address': rng.choice([f'{i} 2ND AVE, SEATTLE, WA, 98104, UNITED STATES' for i in range(200)], n_rows),
+        'Status': rng.choice(['Active', 'Inactive', 'Administratively Dissolved'], n_rows),
+        'address_match': rng.random(n_rows) < 0.3,
+        'ubi_match': False,
+        'id_match': False,
+    })
+
+
+def principal_table(n_rows: int, principals_per_business: int = 5, overlap: float = 0.2, seed: int = 0) -> pd.DataFrame:
+    """
+        A table like all_matches_principals.csv with `n_rows` principal rows.
+        `overlap` tunes how often businesses share principals: it's the size of the principal pool relative to the
+        number of rows, so smaller values mean more sharing (0.2 means each principal is on ~5 businesses).
+    """
+    rng = np.random.default_rng(seed)
+    n_businesses = max(1, n_rows // principals_per_business)
+    business_idx = np.repeat(np.arange(n_businesses), principals_per_business)[:n_rows]
+    pool_size = max(1, int(n_rows * overlap))
+    pool = np.array([f'{f} {l} {i}' for i, (f, l) in enumerate(zip(rng.choice(first_names, pool_size),
+                                                                       rng.choice(last_names, pool_size)))])
+    names = np.array(company_names(n_businesses, seed), dtype=object)
+
+    return pd.DataFrame({
+        'SearchTerm': names[business_idx],
+        'BusinessName': names[business_idx],
+        'UBINumber': (600000000 + business_idx).astype(str),
+        'BusinessId': 10**6 + business_idx,
+        'Address': np.array([f'{i} PINE ST, SEATTLE, WA, 98101, UNITED STATES' for i in range(n_businesses)])[business_idx],
+        'Status': 'Active',
+        'Agent': rng.choice(agents, n_businesses)[business_idx],
+        'EntityType': 'Individual',
+        'PrincipalID': rng.integers(10**6, 10**7, n_rows),
+        'PrincipalName': pool[rng.integers(0, pool_size, n_rows)],
+    })
+
+
+def business_details(business_id: int, n_principals: int = 5, seed: int = 0) -> dict:
+    """ A BusinessInformation response like get_business_details returns. """
+    rng = np.random.default_rng(seed + business_id)
+    principals = [{'TypeID': 'I', 'PrincipalID': int(rng.integers(10**6, 10**7)),
+                   'FirstName': str(rng.choice(first_names)), 'LastName': str(rng.choice(last_names)), 'Name': None}
+                  for _ in range(n_principals)]
+    return {
+        'UBINumber': f'{600000000 + business_id}',
+        'BusinessStatus': 'Active',
+        'Agent': {'EntityName': str(rng.choice(agents))},
+        'PrincipalOffice': {'PrincipalStreetAddress': {'FullAddress': f'{business_id % 500} PINE ST, SEATTLE, WA'}},
+        'PrincipalsList': principals,
+    }
+
+
+def search_page(name: str, page: int, page_count: int, results_per_owner: int = 20) -> list:
+    """ Page `page` of a registry business search for `name` with `results_per_owner` results, the first one exact. """
+    start = (page - 1) * page_count
+    stop = min(results_per_owner, start + page_count)
+    return [{
+        'BusinessName': name if i == 0 else f'{name} {i}',
+        'UBINumber': f'{600000000 + i}',
+        'BusinessID': 10**6 + i,
+        'PrincipalOffice': {'PrincipalStreetAddress': {'FullAddress': f'{i % 7} PINE ST, SEATTLE, WA'}},
+        'BusinessStatus': 'Active',
+    } for i in range(start, stop)]
+
+
+class StubRegistryEngine(FetchEngine):
+    """
+        FetchEngine that answers registry calls with synthetic responses instead of going to the network.
+        Business searches return `results_per_owner` results, one of them matching the search exactly.
+    """
+    def __init__(self, results_per_owner: int = 20, **kwargs):
+        super().__init__(**kwargs)
+        self.results_per_owner = results_per_owner
+
+    def post_json(self, url, data=None, **kwargs):
+        return search_page(data['SearchValue'], int(data['PageID']), int(data['PageCount']), self.results_per_owner)
+
+    def get_json(self, url, **kwargs):
+        return business_details(int(url.rsplit('=', 1)[-1]))
+
+
+class _RegistryHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        content = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        stub = self.server.stub
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+        name = form['SearchValue']
+        stub.record(name)
+        if name in stub.failing:
+            return self._reply(503)
+        time.sleep(stub.latency * random.uniform(0.5, 1.5))
+        self._reply(200, search_page(name, int(form['PageID']), int(form['PageCount']), stub.results_per_owner))
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.record(self.path)
+        time.sleep(stub.latency * random.uniform(0.5, 1.5))
+        self._reply(200, business_details(int(self.path.rsplit('=', 1)[-1])))
+
+
+class StubRegistryServer:
+    """
+        Local HTTP server answering registry calls like StubRegistryEngine, so requests go through the whole
+        FetchEngine path (pooled session, rate limiter, retries) instead of skipping it. Use it with
+        LocalRegistryEngine:
+
+            with StubRegistryServer(latency=0.005) as server:
+                helper = LookupCompaniesHelper(out_path, engine=LocalRegistryEngine(server.url, max_workers=8))
+
+        latency: average seconds each response takes, jittered so concurrent requests finish out of order.
+        failing: search names answered with a 503 every time.
+        `requests` counts the requests received per search name (or GET path).
+    """
+    def __init__(self, results_per_owner: int = 20, latency: float = 0.0, failing=()):
+        self.results_per_owner = results_per_owner
+        self.latency = latency
+        self.failing = set(failing)
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _RegistryHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self.url = f'http://127.0.0.1:{self._httpd.server_port}'
+
+    def record(self, key):
+        with self._lock:
+            self.requests[key] += 1
+
+    def __enter__(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class LocalRegistryEngine(FetchEngine):
+    """ FetchEngine sending the registry requests to `base_url` (eg. a StubRegistryServer) instead of the registry. """
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, url, **kwargs):
+        parts = urllib.parse.urlsplit(url)
+        local = self.base_url + parts.path + (f'?{parts.query}' if parts.query else '')
+        return super().request(method, local, **kwargs)
@@ -5,7 +5,8 @@ version='0.1',
 description='An example package',
 url='#',
 author='',
-install_requires=['numpy', 'pandas', 'shapely', 'geopandas', 'matplotlib'],
+install_requires=['numpy', 'pandas', 'shapely', 'geopandas', 'matplotlib', 'requests', 'pyarrow'],
 author_email='',
 packages=setuptools.find_packages(),
+entry_points={'console_scripts': ['bps-owners=utils.cli:main']},
 zip_safe=False)
\ No newline at end of file
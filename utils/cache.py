@@ -0,0 +1,156 @@
+"""
+    On-disk response cache for the CCFS business registry API calls in utils/owners.py.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import hashlib
+import urllib.parse
+from concurrent.futures import Future
+
+
+class OfflineCacheMiss(LookupError):
+    """ Raised when the cache is in offline (cache-only) mode and a request has no cached response. """
+
+
+def normalize_payload(payload) -> str:
+    """
+        Turns a request payload into a canonical string so that equivalent requests share a cache key.
+        Accepts a dict of form fields, an already urlencoded form string (like the principal search body) or None.
+    """
+    if payload is None:
+        return ''
+    if isinstance(payload, str):
+        # parse_qsl drops the empty `&&` segments the principal search body is full of
+        payload = urllib.parse.parse_qsl(payload, keep_blank_values=True)
+    elif isinstance(payload, dict):
+        payload = payload.items()
+    return json.dumps(sorted((str(k), str(v)) for k, v in payload))
+
+
+def make_key(endpoint: str, payload=None) -> str:
+    """ Cache key for a request: a hash of the endpoint plus its normalized payload. """
+    return hashlib.sha256(f'{endpoint}\n{normalize_payload(payload)}'.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+        SQLite backed cache of decoded JSON responses.
+
+        path: the SQLite file to store responses in, use ':memory:' for a throwaway cache.
+        ttl: seconds before an entry is considered stale and refetched, None to keep entries forever.
+        max_entries: upper bound on the number of stored responses, the least recently used are evicted past it.
+        offline: cache-only mode, never call the registry. Stale entries are still served and a miss raises
+            OfflineCacheMiss.
+
+        Safe to share between threads. Concurrent requests for the same key are coalesced so only one of them
+        actually reaches the registry, the others wait for its response.
+    """
+    def __init__(self, path: str = 'ccfs_cache.sqlite', ttl: float = None, max_entries: int = None,
+                 offline: bool = False):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._in_flight = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                endpoint TEXT,
+                                value TEXT,
+                                created_at REAL,
+                                accessed_at REAL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def _is_fresh(self, created_at):
+        return self.offline or self.ttl is None or time.time() - created_at < self.ttl
+
+    def get(self, key: str):
+        """ Returns (found, value) for `key`, treating stale entries as missing. """
+        with self._lock:
+            row = self._conn.execute('SELECT value, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or not self._is_fresh(row[1]):
+                return False, None
+            self._conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+        return True, json.loads(row[0])
+
+    def set(self, key: str, value, endpoint: str = ''):
+        """ Stores a JSON serializable `value` under `key`, evicting least recently used entries past max_entries. """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                               (key, endpoint, json.dumps(value), now, now))
+            if self.max_entries is not None:
+                self._conn.execute('''DELETE FROM responses WHERE key IN (
+                                        SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)''',
+                                   (self.max_entries,))
+            self._conn.commit()
+
+    def expire(self):
+        """ Deletes every stale entry, returns how many were removed. """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            cur = self._conn.execute('DELETE FROM responses WHERE created_at <= ?', (time.time() - self.ttl,))
+            self._conn.commit()
+        return cur.rowcount
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def fetch(self, endpoint: str, payload, request):
+        """
+            Returns the cached response for `endpoint` + `payload`, calling `request()` to get (and store) it on a miss.
+            `request` should return the decoded JSON response and raise if the call failed, failures aren't cached.
+        """
+        key = make_key(endpoint, payload)
+        with self._lock:
+            pending = self._in_flight.get(key)
+            leader = pending is None
+            if leader:
+                found, value = self.get(key)
+                if found:
+                    self.hits += 1
+                    return value
+                if self.offline:
+                    raise OfflineCacheMiss(f'No cached response for {endpoint} with payload {normalize_payload(payload)}')
+                pending = self._in_flight[key] = Future()
+        if not leader:
+            return pending.result()
+
+        self.misses += 1
+        try:
+            value = request()
+            self.set(key, value, endpoint)
+            pending.set_result(value)
+            return value
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+def cached_fetch(cache: ResponseCache, endpoint: str, payload, request):
+    """ Goes through `cache` when one is configured, otherwise just calls `request()`. """
+    if cache is None:
+        return request()
+    return cache.fetch(endpoint, payload, request)
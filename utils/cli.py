@@ -0,0 +1,117 @@
+"""
+    Command line entry point for batch owner lookups, installed as `bps-owners` (see setup.py).
+
+    Look up the owners in one chunk, or a range of chunks, and write the exact, potential and additional matches:
+        bps-owners lookup data/building_owners/initial_owner_search/owner_search_chunk_3.csv --out results/
+        bps-owners lookup "data/building_owners/initial_owner_search/owner_search_chunk_{n}.csv" --chunks 1-11 --out results/
+    Group companies by shared principals, from one principals csv or a range of chunks:
+        bps-owners group experiments/landlords/parent_company_search/all_matches_principals.csv --out results/ --name companies_and_potential_matches.csv
+        bps-owners group "data/building_owners/principals/principals_search_chunk_{n}.csv" --chunks 1-11 --out results/
+
+    Heavy modules are only imported once the arguments are parsed, so a worker starts quickly.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+from utils.cache import OfflineCacheMiss
+
+
+def parse_chunks(chunks: str) -> list:
+    """ '3' -> [3], '1-11' -> [1, ..., 11], '1,4-5' -> [1, 4, 5] """
+    numbers = []
+    for part in chunks.split(','):
+        start, _, stop = part.partition('-')
+        numbers += list(range(int(start), int(stop or start) + 1))
+    return numbers
+
+
+def chunk_files(path: str, chunks: str = None) -> list:
+    """ (batch number, path) of every chunk to process. Batch numbers come from the chunk number in the file name. """
+    if chunks is None:
+        numbers = re.findall(r'\d+', os.path.basename(path))
+        return [(int(numbers[-1]) if numbers else 0, path)]
+    if '{n}' not in path:
+        raise SystemExit('--chunks needs a path with {n} where the chunk number goes')
+    return [(n, path.format(n=n)) for n in parse_chunks(chunks)]
+
+
+def build_cache_and_engine(args):
+    from utils.cache import ResponseCache
+    from utils.fetch import FetchEngine
+    cache = ResponseCache(args.cache, ttl=args.cache_ttl, offline=args.offline) if args.cache else None
+    engine = FetchEngine(max_workers=args.workers, rate=args.rate)
+    return cache, engine
+
+
+def lookup(args):
+    import pandas as pd
+    from utils.owners import LookupCompaniesHelper
+    cache, engine = build_cache_and_engine(args)
+    helper = LookupCompaniesHelper(args.out, cache=cache, engine=engine, top_k=args.top_k)
+    for x, path in chunk_files(args.path, args.chunks):
+        owners = pd.read_csv(path)[args.column].dropna().unique().tolist()
+        print(f"Chunk {x}: looking up {len(owners)} owners from {path}")
+        helper.get_company_matches_and_export(owners, args.batch if args.batch is not None else x,
+                                              batch_size=args.batch_size)
+
+
+def group(args):
+    import pandas as pd
+    from utils.owners import GroupCompaniesHelper
+    helper = GroupCompaniesHelper(os.path.join(args.out, ''), args.name)
+    # Chunks are grouped together, companies in different chunks can share principals
+    paths = [path for _, path in chunk_files(args.path, args.chunks)]
+    print(f"Grouping the principals in {len(paths)} file(s)")
+    principals = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+    helper.group_companies_by_principals(principals, link_on=tuple(args.link_on))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bps-owners', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--metrics', help='write stage and request metrics to this JSON lines file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    lookup_parser = commands.add_parser('lookup', help='look up owner names in the CCFS registry')
+    lookup_parser.add_argument('path', help='owner chunk csv, or a template with {n} when used with --chunks')
+    lookup_parser.add_argument('--chunks', help="chunk numbers to fill {n} with, eg. '1-11' or '1,4-5'")
+    lookup_parser.add_argument('--column', default='SearchTerm', help='column holding the owner names')
+    lookup_parser.add_argument('--out', required=True, help='folder for the match csvs')
+    lookup_parser.add_argument('--batch', type=int, help='batch number for the output files, defaults to the chunk number')
+    lookup_parser.add_argument('--batch-size', type=int, default=25, help='owners per checkpoint')
+    lookup_parser.add_argument('--workers', type=int, default=1, help='concurrent registry requests')
+    lookup_parser.add_argument('--rate', type=float, help='maximum registry requests per second')
+    lookup_parser.add_argument('--cache', help='SQLite file caching registry responses')
+    lookup_parser.add_argument('--cache-ttl', type=float, help='seconds before cached responses are refetched')
+    lookup_parser.add_argument('--offline', action='store_true', help='only use cached responses')
+    lookup_parser.add_argument('--top-k', type=int, help='only keep the best ranked potential matches per owner')
+    lookup_parser.set_defaults(run=lookup)
+
+    group_parser = commands.add_parser('group', help='group companies by shared principals')
+    group_parser.add_argument('path', help='principals csv like all_matches_principals.csv, or a template with {n} when used with --chunks')
+    group_parser.add_argument('--chunks', help="chunk numbers to fill {n} with, eg. '1-11' or '1,4-5'")
+    group_parser.add_argument('--out', required=True, help='folder for the output csv')
+    group_parser.add_argument('--name', default='companies_and_potential_matches.csv', help='output file name')
+    group_parser.add_argument('--link-on', nargs='+', default=['PrincipalName'],
+                              choices=['PrincipalName', 'Agent', 'Address'], help='columns that link companies')
+    group_parser.set_defaults(run=group)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'offline', False) and not args.cache:
+        parser.error('--offline needs a --cache to read from')
+    if args.metrics:
+        from utils import instrument
+        instrument.enable(instrument.JsonLinesSink(args.metrics))
+    os.makedirs(args.out, exist_ok=True)
+    try:
+        args.run(args)
+    except OfflineCacheMiss as e:
+        parser.exit(1, f"{parser.prog}: error: {e}. Rerun without --offline to fetch it.\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
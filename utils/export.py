@@ -0,0 +1,128 @@
+"""
+    Streaming, resumable CSV output for long running lookups in utils/owners.py.
+"""
+
+import json
+import os
+import shutil
+import uuid
+
+import pandas as pd
+
+
+class ShardedExport:
+    """
+        Append-only output for a job that produces several CSV outputs batch by batch, eg. the exact, potential and
+        additional matches of an owner lookup.
+
+        Every call to `append` adds the batch's rows to one shard file per output under `{out_dir}/{name}_parts/`, then
+        records the batch and the keys it covered (eg. the search terms) in a manifest. A rerun can skip the keys in
+        `completed()`, and `finalize` compacts the shards into the final CSVs. Every batch gets a fresh random id, so
+        rows written by a batch that crashed before reaching the manifest never match a completed batch and are left
+        out when finalizing.
+
+        Every shard keeps the columns of the batch that started it. A batch with other columns (eg. a rerun with
+        different options) raises a ValueError instead of being appended, start over in a new `out_dir` or `name`.
+
+        key_col: the column holding each row's key (eg. 'SearchTerm'). With it, `read` and `finalize` can be limited to
+            the rows of some keys, in the order of the keys.
+    """
+    batch_col = '_batch'
+
+    def __init__(self, out_dir: str, name: str, outputs: list, key_col: str = None):
+        self.outputs = list(outputs)
+        self.key_col = key_col
+        self.parts_dir = os.path.join(out_dir, f'{name}_parts')
+        self.manifest_path = os.path.join(self.parts_dir, 'manifest.jsonl')
+        os.makedirs(self.parts_dir, exist_ok=True)
+        self._batches = self._read_manifest()
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return []
+        with open(self.manifest_path) as f:
+            text = f.read()
+        # A crash mid-write can leave a partial last line, that batch just didn't complete
+        complete = text[:text.rfind('\n') + 1]
+        if complete != text:
+            with open(self.manifest_path, 'w') as f:
+                f.write(complete)
+        return [json.loads(line) for line in complete.splitlines()]
+
+    def _shard_path(self, output):
+        return os.path.join(self.parts_dir, f'{output}.csv')
+
+    def completed(self) -> set:
+        """ Every key covered by a completed batch. """
+        return {key for batch in self._batches for key in batch['keys']}
+
+    def _header(self, output):
+        """ Columns of the shard of `output`, None before its first rows are written. """
+        path = self._shard_path(output)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        return list(pd.read_csv(path, nrows=0).columns)
+
+    def append(self, keys: list, frames: dict):
+        """ Appends one batch: `frames` maps each output name to the rows it produced for `keys`. """
+        batch = uuid.uuid4().hex
+        rows = {}
+        # Check every output first, so a mismatch doesn't leave the batch half written
+        for output in self.outputs:
+            df = frames.get(output)
+            if df is None or len(df) == 0:
+                continue
+            df = df.assign(**{self.batch_col: batch})
+            header = self._header(output)
+            if header is not None:
+                if set(df.columns) != set(header):
+                    raise ValueError(f"{output} rows have columns {list(df.columns)} but {self._shard_path(output)} "
+                                     f"was started with {header}, rerun with the same options or delete "
+                                     f"{self.parts_dir} to start over")
+                df = df[header]
+            rows[output] = (df, header is None)
+
+        for output, (df, write_header) in rows.items():
+            df.to_csv(self._shard_path(output), mode='a', header=write_header, index=False)
+
+        record = {'batch': batch, 'keys': list(keys)}
+        with open(self.manifest_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._batches.append(record)
+
+    def read(self, output: str, keys: list = None) -> pd.DataFrame:
+        """
+            All rows appended to `output` by completed batches. With `keys` (needs key_col), only the rows of those
+            keys, in the order of `keys`.
+        """
+        path = self._shard_path(output)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return pd.DataFrame()
+        dtypes = {self.batch_col: str, **({self.key_col: str} if self.key_col else {})}
+        df = pd.read_csv(path, dtype=dtypes)
+        done = {str(batch['batch']) for batch in self._batches}
+        keep = df[self.batch_col].isin(done)
+        df = df[keep]
+        if keys is not None:
+            order = {key: i for i, key in enumerate(keys)}
+            df = df[df[self.key_col].isin(list(order))]
+            df = df.iloc[df[self.key_col].map(order).argsort(kind='stable')]
+        return df.drop(columns=self.batch_col).reset_index(drop=True)
+
+    def finalize(self, paths: dict, empty_columns: list = None, cleanup: bool = False, keys: list = None):
+        """
+            Compacts the shards into the final CSV for each output, `paths` maps output names to their destination.
+            With `keys`, only the rows of those keys are written, in that order, so earlier runs covering other keys
+            don't leak in and resumed runs come out in the same order as uninterrupted ones.
+            Outputs without any rows are written with `empty_columns`. With `cleanup` the shards and manifest are
+            removed afterwards, so the next run starts from scratch.
+        """
+        for output, path in paths.items():
+            df = self.read(output, keys)
+            if len(df.columns) == 0 and empty_columns is not None:
+                df = pd.DataFrame([], columns=empty_columns)
+            df.to_csv(path)
+        if cleanup:
+            shutil.rmtree(self.parts_dir)
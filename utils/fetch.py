@@ -0,0 +1,154 @@
+"""
+    Concurrent, rate limited HTTP fetching for the CCFS registry lookups in utils/owners.py.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import instrument
+
+# Responses worth retrying, the registry returns these when it's overloaded or throttling us
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+        Token bucket rate limiter shared between worker threads.
+        rate: tokens added per second, ie. the sustained request rate.
+        capacity: how many requests can go out back to back after an idle period.
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a token is available and takes it. """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class FetchEngine:
+    """
+        Runs registry requests over a pooled requests.Session with a worker thread pool.
+
+        max_workers: how many requests can be in flight at once.
+        rate: maximum requests per second across all workers, None for no limit.
+        burst: how many requests can go out at once before `rate` kicks in, defaults to `rate`.
+        retries: how many times a failed request (connection error, timeout, or a RETRY_STATUSES response) is retried.
+        backoff: base delay in seconds between retries, doubled on every attempt.
+        timeout: per request timeout in seconds.
+        page_window: how many pages `paginate` requests at once. Pages past the last one are wasted requests,
+            so keep this at 1 unless most searches are known to return several pages.
+    """
+    def __init__(self, max_workers: int = 4, rate: float = None, burst: float = None, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = 30, page_window: int = 1, session: requests.Session = None):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.page_window = page_window
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.session = session if session is not None else requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2 ** attempt
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+            Sends one request through the shared session, waiting on the rate limiter and retrying with backoff.
+            Raises requests.HTTPError if the response still has a RETRY_STATUSES status once the retries run out.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                instrument.record_request(method, url, type(e).__name__, time.perf_counter() - start, 0, attempt=attempt)
+                if attempt == self.retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                continue
+            instrument.record_request(method, url, r.status_code, time.perf_counter() - start, len(r.content), attempt=attempt)
+            if r.status_code not in RETRY_STATUSES:
+                return r
+            if attempt == self.retries:
+                r.raise_for_status()
+            time.sleep(self._retry_delay(attempt, r))
+
+    def get_json(self, url: str, **kwargs):
+        r = self.request('GET', url, **kwargs)
+        with instrument.stage('json_parse'):
+            return json.loads(r.text)
+
+    def post_json(self, url: str, data=None, **kwargs):
+        r = self.request('POST', url, data=data, **kwargs)
+        with instrument.stage('json_parse'):
+            return json.loads(r.text)
+
+    def map(self, fn, items) -> list:
+        """ Calls `fn` on every item using the worker pool, results are returned in the same order as `items`. """
+        items = list(items)
+        # Nested calls from inside a worker run inline, waiting on the pool from one of its own threads can deadlock
+        if self.max_workers <= 1 or len(items) <= 1 or getattr(self._local, 'in_worker', False):
+            return [fn(item) for item in items]
+
+        def run(item):
+            self._local.in_worker = True
+            try:
+                return fn(item)
+            finally:
+                self._local.in_worker = False
+        return list(self._executor.map(run, items))
+
+    def paginate(self, fetch_page, page_size: int = 100) -> list:
+        """
+            Collects every result of a paged search. `fetch_page(n)` returns the list of results on page n (1 indexed),
+            and the last page is the first one holding fewer than `page_size` results.
+            `page_window` pages are requested at a time, results keep their page order.
+        """
+        results = []
+        n = 1
+        while True:
+            pages = self.map(fetch_page, range(n, n + self.page_window))
+            for page in pages:
+                results += page
+                if len(page) != page_size:
+                    return results
+            n += self.page_window
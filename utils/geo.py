@@ -2,11 +2,22 @@
 Utility functions, mainly for preprocessing data.
 Used in experiment notebooks. 
 """
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING
+
 import numpy as np
 import pandas as pd
-import geopandas as gp
-from shapely.geometry import Polygon, LineString, Point
-import matplotlib.pyplot as plt
+
+from utils import instrument
+from utils.geocode import normalize_parcels
+
+if TYPE_CHECKING:
+    import geopandas as gp
+
+# geopandas, shapely and matplotlib take seconds to import, so they aren't imported here. These functions work on the
+# geodataframes passed in, and import geopandas themselves only where they need it.
 
 # Some points I've already figured out, usually because they're on the water. 
 # Might be better to use addresses
@@ -19,23 +30,172 @@ known_updates = {
     'PIER AT LESCHI THE':3
 }
 
+# District code for buildings whose point falls outside every district polygon.
+UNKNOWN_DISTRICT = -1
+
+
+class DistrictAssigner:
+    """
+        Assigns council districts to building points in bulk.
+        The spatial index over the district polygons is built once when the assigner is created, so it can be
+        reused across many calls (eg. one per yearly dataset) without rebuilding.
+    """
+    def __init__(self, df_districts: 'gp.GeoDataFrame', district_col: str = 'C_DISTRICT'):
+        self.district_col = district_col
+        self.districts = df_districts[[district_col, 'geometry']].reset_index(drop=True)
+        # Touching .sindex builds and caches the STRtree on the frame, sjoin reuses it
+        self.districts.sindex
+
+    def assign(self, points: 'gp.GeoSeries', parcels: pd.Series = None) -> pd.Series:
+        """
+            Returns a series aligned with `points` holding the district each point falls in, or UNKNOWN_DISTRICT.
+            When a point touches more than one district, the last district in the file wins.
+            `parcels` isn't needed here, DistrictCache uses it as part of its key.
+        """
+        import geopandas as gp
+        left = gp.GeoDataFrame(geometry=points.reset_index(drop=True), crs=points.crs)
+        joined = gp.sjoin(left, self.districts, how='inner', predicate='intersects')
+        joined = joined.sort_values('index_right', kind='stable')
+        joined = joined[~joined.index.duplicated(keep='last')]
+
+        districts = np.full(len(points), UNKNOWN_DISTRICT, dtype=np.int64)
+        districts[joined.index.to_numpy()] = joined[self.district_col].to_numpy()
+        return pd.Series(districts, index=points.index, name='CouncilDistrictCode')
+
+    def apply_known_updates(self, df: pd.DataFrame, districts: pd.Series) -> pd.Series:
+        """ Fill unknown districts from `known_updates` by building name. """
+        fallback = df['BuildingName'].astype(str).str.upper().map(known_updates)
+        unknown = (districts == UNKNOWN_DISTRICT) & fallback.notna()
+        return districts.mask(unknown, fallback).astype(np.int64)
+
+
+def district_hashes(df_districts: 'gp.GeoDataFrame', district_col: str = 'C_DISTRICT') -> list:
+    """ [district, hash of its polygon] for every district, in file order. """
+    return [[int(code), hashlib.sha256(geometry.wkb).hexdigest()[:16]]
+            for code, geometry in zip(df_districts[district_col], df_districts['geometry'])]
+
+
+class DistrictCache(DistrictAssigner):
+    """
+        DistrictAssigner that remembers its assignments in a Parquet file, so reprocessing the yearly datasets only
+        runs point-in-polygon for the parcels that are new or have moved since a previous run.
+
+        Assignments are keyed by tax parcel number and the point's coordinates rounded to `precision` decimals.
+        The cache also stores a hash of every district polygon (in `{path}.json`). When Council_Districts.geojson
+        changes, only the assignments that could be affected are dropped: the ones in a district whose polygon changed,
+        and the ones whose point falls in a changed polygon. Reordering or renumbering the districts drops everything.
+        Needs pyarrow.
+    """
+    def __init__(self, df_districts: 'gp.GeoDataFrame', path: str = 'district_assignments.parquet',
+                 district_col: str = 'C_DISTRICT', precision: int = 6):
+        super().__init__(df_districts, district_col)
+        self.path = path
+        self.precision = precision
+        self.scale = 10 ** precision
+        self.hashes = district_hashes(self.districts, district_col)
+        self.hits = 0
+        self.misses = 0
+
+        self.entries = pd.DataFrame({'parcel': pd.Series(dtype=str), 'x': pd.Series(dtype=np.int64),
+                                     'y': pd.Series(dtype=np.int64), 'district': pd.Series(dtype=np.int64)})
+        if os.path.exists(path) and os.path.exists(path + '.json'):
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            if meta['precision'] == precision:
+                self.entries = pd.read_parquet(path)
+                self._invalidate_changed(meta['districts'])
+        self.save()
+
+    @property
+    def version(self) -> str:
+        """ Hash of all the district polygons the cached assignments were made with. """
+        return hashlib.sha256(json.dumps(self.hashes).encode('utf-8')).hexdigest()[:16]
+
+    def _invalidate_changed(self, old_hashes):
+        if old_hashes == self.hashes:
+            return
+        if [code for code, _ in old_hashes] != [code for code, _ in self.hashes]:
+            self.entries = self.entries.iloc[:0]
+            return
+        changed = [i for i, (old, new) in enumerate(zip(old_hashes, self.hashes)) if old != new]
+        changed_codes = [self.hashes[i][0] for i in changed]
+
+        import geopandas as gp
+        points = gp.GeoSeries(gp.points_from_xy(self.entries['x'] / self.scale, self.entries['y'] / self.scale),
+                              crs=self.districts.crs)
+        joined = gp.sjoin(gp.GeoDataFrame(geometry=points), self.districts.iloc[changed], how='inner',
+                          predicate='intersects')
+        affected = np.array(self.entries['district'].isin(changed_codes))
+        affected[joined.index.unique().to_numpy()] = True
+        self.entries = self.entries[~affected].reset_index(drop=True)
+
+    def _keys(self, points, parcels):
+        xy = np.column_stack([points.x.to_numpy(), points.y.to_numpy()])
+        parcels = np.full(len(points), '') if parcels is None else normalize_parcels(parcels).to_numpy()
+        valid = np.isfinite(xy).all(axis=1)
+        quantized = np.zeros(xy.shape, dtype=np.int64)
+        quantized[valid] = np.round(xy[valid] * self.scale).astype(np.int64)
+        return pd.DataFrame({'parcel': parcels, 'x': quantized[:, 0], 'y': quantized[:, 1]}), valid
+
+    def assign(self, points: 'gp.GeoSeries', parcels: pd.Series = None) -> pd.Series:
+        """
+            Like DistrictAssigner.assign, but only points missing from the cache go through the spatial join.
+            New assignments are saved before returning.
+        """
+        keys, valid = self._keys(points, parcels)
+        cached = keys.merge(self.entries, how='left', on=['parcel', 'x', 'y'])['district'].to_numpy()
+        miss = np.isnan(cached) | ~valid
+        self.hits += int((~miss).sum())
+        self.misses += int(miss.sum())
+
+        districts = np.where(miss, UNKNOWN_DISTRICT, np.nan_to_num(cached)).astype(np.int64)
+        with instrument.stage('district_cache', rows=len(points), hits=int((~miss).sum())):
+            if miss.any():
+                districts[miss] = super().assign(points[miss]).to_numpy()
+                new = keys[miss & valid].assign(district=districts[miss & valid])
+                self.entries = (pd.concat([self.entries, new], ignore_index=True)
+                                  .drop_duplicates(['parcel', 'x', 'y'], keep='last', ignore_index=True))
+                self.save()
+        return pd.Series(districts, index=points.index, name='CouncilDistrictCode')
+
+    def save(self):
+        # Write to temporary files first so a failed write never leaves a half written cache behind
+        self.entries.to_parquet(self.path + '.tmp', index=False)
+        with open(self.path + '.json.tmp', 'w') as f:
+            json.dump({'version': self.version, 'precision': self.precision, 'districts': self.hashes}, f)
+        os.replace(self.path + '.tmp', self.path)
+        os.replace(self.path + '.json.tmp', self.path + '.json')
+
+    def clear(self):
+        self.entries = self.entries.iloc[:0]
+        self.save()
+
+
 # Go through all of the building and lookup their (long, lat) to update what district they're in. 
 # Outliers are left with a -1 district code and examined manually later. 
-def clean_districts(df, df_districts):
-    for idx, row in df.iterrows():
-        point = row['geometry']
-        district = -1 # Flag an unkonwn district
-        for gidx, grow in df_districts.iterrows():
-            if(grow['geometry'].intersects(point)): 
-                district = grow['C_DISTRICT']
-        if(district < 0):
-            print( f"Building {row.BuildingName} {idx}/ {row.TaxParcelIdentificationNumber} doesn't have a district {row.geometry} ")
-            if(row.BuildingName.upper() in known_updates.keys()):
-                district = known_updates[row.BuildingName.upper()]
-                print(f"\t Found district {district} for {row.BuildingName}")
-        df.at[idx, 'CouncilDistrictCode'] = district
+# Returns the cleaned dataframe (without rows missing lat, long info) and a report of the buildings that didn't
+# land in any district, with `resolved` marking the ones fixed up by `known_updates`.
+# Pass a DistrictCache as `assigner` to reuse the assignments from previous years' runs.
+def clean_districts(df, df_districts, assigner=None):
+    if assigner is None:
+        with instrument.stage('build_district_index'):
+            assigner = DistrictAssigner(df_districts)
+    has_point = ~df['geometry'].is_empty
+
+    districts = pd.Series(UNKNOWN_DISTRICT, index=df.index, dtype=np.int64)
+    with instrument.stage('assign_districts', rows=int(has_point.sum())):
+        districts[has_point] = assigner.assign(df.loc[has_point, 'geometry'],
+                                               df.loc[has_point, 'TaxParcelIdentificationNumber'])
+    unmatched = districts == UNKNOWN_DISTRICT
+    districts = assigner.apply_known_updates(df, districts)
+    df['CouncilDistrictCode'] = districts
+
+    report = df.loc[unmatched, ['BuildingName', 'TaxParcelIdentificationNumber', 'geometry', 'CouncilDistrictCode']].copy()
+    report['resolved'] = report['CouncilDistrictCode'] != UNKNOWN_DISTRICT
+
     # Drop lines that don't have any lat, long info
-    df = df.drop(df[df['geometry'].is_empty==True].index)
+    df = df[has_point]
+    return df, report
 
 # Plot the district boundaries and building (long, lat) points color-coded by the predicted districts. 
 # Extra dark points have a district of -1. 
@@ -0,0 +1,172 @@
+"""
+    Offline geocoding for buildings missing coordinates (eg. the 2015 benchmark data), using the latitude and longitude
+    of the same addresses and parcels in other years' data instead of calling a geocoding API.
+
+        index = AddressIndex.from_csvs(['experiments/landlords/parcel_owners/buildings_2020.csv'])
+        df_2015 = geocode_buildings(df_2015, index)
+        df_2015, report = clean_districts(df_2015, df_districts)
+"""
+
+import difflib
+import re
+
+import numpy as np
+import pandas as pd
+
+from utils import instrument
+
+# Street words written out in some years and abbreviated in others
+street_abbreviations = {
+    'STREET': 'ST', 'AVENUE': 'AVE', 'AV': 'AVE', 'PLACE': 'PL', 'BOULEVARD': 'BLVD', 'DRIVE': 'DR', 'ROAD': 'RD',
+    'COURT': 'CT', 'LANE': 'LN', 'PARKWAY': 'PKWY', 'TERRACE': 'TER', 'CIRCLE': 'CIR', 'HIGHWAY': 'HWY',
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+    'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW',
+    'FIRST': '1ST', 'SECOND': '2ND', 'THIRD': '3RD', 'FOURTH': '4TH', 'FIFTH': '5TH', 'SIXTH': '6TH',
+    'SEVENTH': '7TH', 'EIGHTH': '8TH', 'NINTH': '9TH',
+}
+abbreviation_pattern = re.compile(r"\b(?:" + '|'.join(street_abbreviations) + r")\b")
+# Suite/unit numbers at the end of an address, eg. '1200 5TH AVE STE 300', '401 BROADWAY #2'
+unit_pattern = re.compile(r"\s+(?:#|APT|UNIT|STE|SUITE|BLDG|FL)\b\.?\s*\S*$|\s+#\s*\S*$")
+# Address ranges like '1200-1210 2ND AVE' are looked up by their first number
+range_pattern = re.compile(r"^(\d+)\s*-\s*\d+\b")
+
+# Columns of the benchmark data the index reads
+index_columns = ['TaxParcelIdentificationNumber', 'DataYear', 'Address', 'ZipCode', 'Latitude', 'Longitude']
+
+
+def normalize_addresses(addresses: pd.Series) -> pd.Series:
+    """
+        Canonical form of every address in `addresses`: upper cased, punctuation and unit numbers dropped, whitespace
+        collapsed and street words abbreviated, eg. '1200-1210 Second Avenue, Suite 300' -> '1200 2ND AVE'.
+    """
+    return (addresses.fillna('').astype(str)
+                     .str.upper()
+                     .str.replace('.', '', regex=False)
+                     .str.replace(',', ' ', regex=False)
+                     .str.replace(r"\s+", ' ', regex=True)
+                     .str.strip()
+                     .str.replace(unit_pattern, '', regex=True)
+                     .str.replace(range_pattern, r'\1', regex=True)
+                     .str.replace(abbreviation_pattern, lambda m: street_abbreviations[m.group(0)], regex=True))
+
+
+def normalize_zips(zips: pd.Series) -> pd.Series:
+    """ 5 digit zip codes as strings, from floats (98101.0), ints or zip+4 ('98101-1234'). Missing zips are ''. """
+    digits = zips.astype('string').str.replace(r'\.0$', '', regex=True).str.extract(r'^(\d{5})', expand=False)
+    return digits.fillna('').astype(str)
+
+
+def normalize_parcels(parcels: pd.Series) -> pd.Series:
+    """ Tax parcel numbers as 10 digit strings, the leading zero is dropped in some years. Missing parcels are ''. """
+    digits = parcels.astype('string').str.replace(r'\.0$', '', regex=True).str.replace(r'\D', '', regex=True)
+    return digits.where(digits.str.len() > 0).str.zfill(10).fillna('').astype(str)
+
+
+class AddressIndex:
+    """
+        Coordinates of every address and parcel in local benchmark data, keyed by normalized address (with and without
+        the zip code) and by tax parcel number. When the same key shows up in more than one year, the latest year wins.
+    """
+    def __init__(self, df: pd.DataFrame, address_col: str = 'Address', zip_col: str = 'ZipCode',
+                 parcel_col: str = 'TaxParcelIdentificationNumber', year_col: str = 'DataYear'):
+        df = df[df['Latitude'].notna() & df['Longitude'].notna()]
+        if year_col in df.columns:
+            df = df.sort_values(year_col, kind='stable')
+        self.coordinates = df[['Latitude', 'Longitude']].to_numpy(dtype=float)
+
+        addresses = normalize_addresses(df[address_col]).to_numpy()
+        zips = normalize_zips(df[zip_col]).to_numpy() if zip_col in df.columns else np.full(len(df), '')
+        parcels = normalize_parcels(df[parcel_col]).to_numpy() if parcel_col in df.columns else np.full(len(df), '')
+
+        # Each key maps to a row of `coordinates`
+        self.by_address_zip = self._positions(pd.Series(addresses) + '|' + zips, addresses != '')
+        self.by_address = self._positions(pd.Series(addresses), addresses != '')
+        self.by_parcel = self._positions(pd.Series(parcels), parcels != '')
+
+        # For the fuzzy fallback, the street names of every house number
+        self.streets = {}
+        for address, position in self.by_address.items():
+            number, _, street = address.partition(' ')
+            self.streets.setdefault(number, {})[street] = position
+
+    @staticmethod
+    def _positions(keys: pd.Series, valid: np.ndarray) -> pd.Series:
+        positions = pd.Series(np.arange(len(keys)), index=keys.to_numpy())[valid]
+        return positions[~positions.index.duplicated(keep='last')]
+
+    @classmethod
+    def from_csvs(cls, paths: list, **kwargs) -> 'AddressIndex':
+        """ Index over the benchmark csvs in `paths`, eg. buildings_2020.csv and later years. """
+        frames = [pd.read_csv(path, usecols=lambda col: col in index_columns, dtype={'TaxParcelIdentificationNumber': str})
+                  for path in paths]
+        return cls(pd.concat(frames, ignore_index=True), **kwargs)
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def _fuzzy(self, address: str, cutoff: float) -> float:
+        """ Position of the closest street name with the same house number, or nan. """
+        number, _, street = address.partition(' ')
+        streets = self.streets.get(number)
+        if not streets or not street:
+            return np.nan
+        match = difflib.get_close_matches(street, list(streets), n=1, cutoff=cutoff)
+        return streets[match[0]] if match else np.nan
+
+    def lookup(self, df: pd.DataFrame, address_col: str = 'Address', zip_col: str = 'ZipCode',
+               parcel_col: str = 'TaxParcelIdentificationNumber', fuzzy_cutoff: float = 0.85) -> pd.DataFrame:
+        """
+            Returns a dataframe aligned with `df` with the Latitude and Longitude found for every row, and how they
+            were found in `geocode_match`: 'address_zip', 'address', 'parcel', 'fuzzy' or None when nothing matched.
+            Exact matches are hash lookups over the whole frame at once, tried from most to least specific.
+            Whatever's left falls back to the closest street name with the same house number (fuzzy_cutoff=None
+            turns that off).
+        """
+        addresses = normalize_addresses(df[address_col]) if address_col in df.columns else pd.Series('', index=df.index)
+        zips = normalize_zips(df[zip_col]) if zip_col in df.columns else pd.Series('', index=df.index)
+        parcels = normalize_parcels(df[parcel_col]) if parcel_col in df.columns else pd.Series('', index=df.index)
+
+        positions = pd.Series(np.nan, index=df.index)
+        match = pd.Series(None, index=df.index, dtype=object)
+        for name, keys, table in [('address_zip', addresses + '|' + zips, self.by_address_zip),
+                                  ('address', addresses, self.by_address),
+                                  ('parcel', parcels, self.by_parcel)]:
+            missing = positions.isna()
+            found = keys[missing].map(table).dropna()
+            positions[found.index] = found
+            match[found.index] = name
+
+        if fuzzy_cutoff is not None:
+            missing = positions.isna() & (addresses != '')
+            if missing.any():
+                found = pd.to_numeric(addresses[missing].map(lambda address: self._fuzzy(address, fuzzy_cutoff))).dropna()
+                positions[found.index] = found
+                match[found.index] = 'fuzzy'
+
+        coordinates = np.full((len(df), 2), np.nan)
+        has_match = positions.notna().to_numpy()
+        coordinates[has_match] = self.coordinates[positions[has_match].astype(int).to_numpy()]
+        return pd.DataFrame({'Latitude': coordinates[:, 0], 'Longitude': coordinates[:, 1], 'geocode_match': match},
+                            index=df.index)
+
+
+# Fill in the missing Latitude and Longitude of `df` from the index and (re)build the point geometries, so the
+# result can go straight into clean_districts. Rows that already have coordinates keep them. Rows the index
+# can't place are left with empty points, like before.
+def geocode_buildings(df, index, **kwargs):
+    import geopandas as gp
+    df = df.copy()
+    for col in ['Latitude', 'Longitude']:
+        if col not in df.columns:
+            df[col] = np.nan
+    missing = df['Latitude'].isna() | df['Longitude'].isna()
+
+    with instrument.stage('geocode', rows=int(missing.sum())) as stage:
+        found = index.lookup(df[missing], **kwargs)
+        stage.set(matched=int(found['geocode_match'].notna().sum()))
+    df.loc[missing, ['Latitude', 'Longitude']] = found[['Latitude', 'Longitude']]
+    df['geocode_match'] = pd.Series(None, index=df.index, dtype=object)
+    df.loc[missing, 'geocode_match'] = found['geocode_match']
+
+    return gp.GeoDataFrame(df.drop(columns='geometry', errors='ignore'),
+                           geometry=gp.points_from_xy(df['Longitude'], df['Latitude']), crs=getattr(df, 'crs', None))
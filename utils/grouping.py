@@ -0,0 +1,105 @@
+"""
+    Grouping companies that are likely owned by the same "root" company, based on shared principals.
+"""
+
+import numpy as np
+import pandas as pd
+
+grouped_columns = ['SearchTerm', 'BusinessName', 'PotentialRelatedCompany', 'UBINumber', 'BusinessId', 'Address',
+                   'Status', 'Agent', 'Principals', 'isMatch', 'notes']
+
+
+class UnionFind:
+    """ Disjoint sets over the integers 0..n-1, with path halving and union by size. """
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, x: int) -> int:
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x: int, y: int):
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return
+        if self.size[x] < self.size[y]:
+            x, y = y, x
+        self.parent[y] = x
+        self.size[x] += self.size[y]
+
+
+def build_inverted_index(business_codes: np.ndarray, values: pd.Series) -> pd.Series:
+    """
+        Maps every value of `values` (eg. a principal's name) to the array of businesses it's listed on.
+        Missing and blank values don't link anything, so they're left out.
+    """
+    valid = (values.notna() & (values.astype(str).str.strip() != '')).to_numpy()
+    return pd.Series(business_codes[valid]).groupby(values[valid].to_numpy(), sort=False).unique()
+
+
+def find_related_companies(principal_match_list: pd.DataFrame, link_on=('PrincipalName',)) -> np.ndarray:
+    """
+        Returns the connected component of every business in `principal_match_list`, in order of first appearance
+        of the business. Two businesses are connected when they share a value in any of the `link_on` columns,
+        and the links are transitive: if A shares a principal with B and B shares one with C, all three are grouped.
+        Components are labelled by their first appearing business. Rows without a BusinessId are ignored.
+    """
+    business_codes, business_ids = pd.factorize(principal_match_list['BusinessId'])
+    has_id = business_codes >= 0
+    uf = UnionFind(len(business_ids))
+    for col in link_on:
+        for businesses in build_inverted_index(business_codes[has_id], principal_match_list[col][has_id]):
+            for other in businesses[1:]:
+                uf.union(businesses[0], other)
+
+    roots = np.array([uf.find(i) for i in range(len(business_ids))], dtype=np.int64)
+    # Relabel each component by its smallest member, ie. the first of its businesses to appear in the input
+    first_member = pd.Series(np.arange(len(roots))).groupby(roots).transform('min').to_numpy()
+    return first_member
+
+
+def group_companies(principal_match_list: pd.DataFrame, link_on=('PrincipalName',)) -> pd.DataFrame:
+    """
+        Given a list of businesses with one line for each principal registered for that business, returns
+        a dataframe where companies are grouped by whether they are connected through shared principals.
+        `link_on` can also include 'Agent' and/or 'Address' to link companies with the same registered agent or address.
+        Note that a handful of registered agents (eg. CORPORATION SERVICE COMPANY) represent thousands of unrelated
+        companies, so linking on Agent makes very large groups.
+
+        Each group is listed together, starting with its hub company (the first one to appear in the input), whose
+        SearchTerm and BusinessName are repeated on every row of the group. There is one row per UBINumber.
+    """
+    df = principal_match_list.dropna(subset=['UBINumber', 'BusinessId']).reset_index(drop=True)
+    if len(df) == 0:
+        return pd.DataFrame([], columns=grouped_columns)
+    components = find_related_companies(df, link_on)
+
+    companies = df.drop_duplicates(subset='BusinessId').reset_index(drop=True)
+    principals = (df.drop_duplicates(subset=['BusinessId', 'PrincipalName'])
+                    .dropna(subset=['PrincipalName'])
+                    .groupby('BusinessId', sort=False)['PrincipalName']
+                    .agg(sorted))
+
+    hubs = companies.iloc[components]
+    results = pd.DataFrame({
+        'SearchTerm': hubs['SearchTerm'].to_numpy(),
+        'BusinessName': hubs['BusinessName'].to_numpy(),
+        'PotentialRelatedCompany': companies['BusinessName'],
+        'UBINumber': companies['UBINumber'],
+        'BusinessId': companies['BusinessId'],
+        'Address': companies['Address'],
+        # The older principals chunks were saved before Status was collected
+        'Status': companies['Status'] if 'Status' in companies.columns else None,
+        'Agent': companies['Agent'],
+        'Principals': companies['BusinessId'].map(principals),
+        'isMatch': '',
+        'notes': '',
+    }, columns=grouped_columns)
+    results['Principals'] = results['Principals'].apply(lambda p: p if isinstance(p, list) else [])
+
+    order = np.lexsort((np.arange(len(companies)), components))
+    return results.iloc[order].drop_duplicates(subset='UBINumber').reset_index(drop=True)
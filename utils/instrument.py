@@ -0,0 +1,164 @@
+"""
+    Lightweight timing and HTTP instrumentation for the owners and geo pipelines.
+
+    Disabled by default. Enable it for a run with
+        from utils import instrument
+        instrument.enable(instrument.JsonLinesSink('run_metrics.jsonl'))
+    and print `instrument.summary()` at the end. While disabled, `stage` hands back a shared no-op context manager
+    and `record_request` returns right away, so the calls can stay in the code paths.
+"""
+
+import json
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class MemorySink:
+    """ Keeps every event in `events`, handy for tests and notebooks. """
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event: dict):
+        self.events.append(event)
+
+
+class JsonLinesSink:
+    """ Writes one JSON object per event to `path`. """
+    def __init__(self, path: str):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def emit(self, event: dict):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class _NullStage:
+    """ What `stage` returns while instrumentation is disabled. """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class _Stage:
+    def __init__(self, instrumentation, name, fields):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        self.instrumentation._record('stage', self.name, seconds, error=exc_type is not None, **self.fields)
+        return False
+
+    def set(self, **fields):
+        """ Attach more fields to the stage's event, eg. `rows` once they're known. """
+        self.fields.update(fields)
+
+
+class Instrumentation:
+    """
+        Collects stage timings (with row counts and other fields) and HTTP request metrics, sends every event to
+        `sink` and keeps the numbers needed for `summary`.
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.enabled = sink is not None
+        self._lock = threading.Lock()
+        self._seconds = {}
+        self._totals = {}
+
+    def _record(self, kind, name, seconds, **fields):
+        event = {'type': kind, 'name': name, 'seconds': seconds, 'time': time.time(), **fields}
+        self.sink.emit(event)
+        with self._lock:
+            self._seconds.setdefault((kind, name), []).append(seconds)
+            totals = self._totals.setdefault((kind, name), {})
+            if kind == 'request':
+                # Requests are counted by status instead of summing the status codes
+                status = f"status_{fields['status']}"
+                totals[status] = totals.get(status, 0) + 1
+                totals['retries'] = totals.get('retries', 0) + (fields.get('attempt', 0) > 0)
+                fields = {'bytes': fields['bytes']}
+            for field, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[field] = totals.get(field, 0) + value
+
+    def stage(self, name: str, **fields):
+        """ Context manager timing one run of the stage `name`. """
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name, fields)
+
+    def record_request(self, method: str, url: str, status, seconds: float, nbytes: int, **fields):
+        """ Records one HTTP request, grouped by method and url without its query string. """
+        if not self.enabled:
+            return
+        self._record('request', f"{method} {url.split('?', 1)[0]}", seconds, status=status, bytes=nbytes, **fields)
+
+    def summary(self) -> pd.DataFrame:
+        """ Count, total and latency percentiles (in seconds) of every stage and endpoint, plus summed fields. """
+        with self._lock:
+            rows = []
+            for (kind, name), seconds in self._seconds.items():
+                seconds = np.array(seconds)
+                rows.append({'type': kind, 'name': name, 'count': len(seconds), 'total_s': seconds.sum(),
+                             'p50_s': np.percentile(seconds, 50), 'p90_s': np.percentile(seconds, 90),
+                             'p99_s': np.percentile(seconds, 99), 'max_s': seconds.max(),
+                             **self._totals[(kind, name)]})
+        return pd.DataFrame(rows)
+
+    def reset(self):
+        with self._lock:
+            self._seconds = {}
+            self._totals = {}
+
+
+# The instrumentation used throughout utils, see enable and disable
+instrumentation = Instrumentation()
+
+
+def enable(sink=None) -> Instrumentation:
+    """ Turns instrumentation on, sending events to `sink` (a MemorySink by default). """
+    global instrumentation
+    instrumentation = Instrumentation(sink if sink is not None else MemorySink())
+    return instrumentation
+
+
+def disable():
+    global instrumentation
+    instrumentation = Instrumentation()
+
+
+def stage(name: str, **fields):
+    return instrumentation.stage(name, **fields)
+
+
+def record_request(method: str, url: str, status, seconds: float, nbytes: int, **fields):
+    instrumentation.record_request(method, url, status, seconds, nbytes, **fields)
+
+
+def summary() -> pd.DataFrame:
+    return instrumentation.summary()
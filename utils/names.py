@@ -0,0 +1,55 @@
+"""
+    Company name normalization, used to match owner names against business names in the CCFS database.
+"""
+
+import re
+
+import pandas as pd
+
+# examples: LLC, LLP, L L C, L.L.C., L.L.C. L.L.P., L.L.P, LLC.
+llc_pattern = re.compile(r"\bL[\s.]?L[\s,.]?[PC]\b\.?", flags=re.IGNORECASE)
+# examples: LP, L P, L.P., L.P
+lp_pattern = re.compile(r"\bL[\s.]?P\b\.?", flags=re.IGNORECASE)
+# Limited Partnership, Limited liability company
+long_form_pattern = re.compile(r"\bLIMITED\s+(?:LIABILITY\s+COMPANY|PARTNERSHIP)\b", flags=re.IGNORECASE)
+whitespace_pattern = re.compile(r"\s+")
+
+
+def normalize_company_names(names: pd.Series) -> pd.Series:
+    """
+        Returns the canonical key of every name in `names`: upper cased, commas dropped, whitespace collapsed and
+        every spelling of LLC, LLP, LP, Limited Partnership and Limited liability company written as LLC.
+        Two names with the same key are considered an exact match.
+    """
+    return (names.fillna('').astype(str)
+                 .str.upper()
+                 .str.replace(',', '', regex=False)
+                 .str.replace(llc_pattern, 'LLC', regex=True)
+                 .str.replace(lp_pattern, 'LLC', regex=True)
+                 .str.replace(long_form_pattern, 'LLC', regex=True)
+                 .str.replace(whitespace_pattern, ' ', regex=True)
+                 .str.strip())
+
+
+def normalize_company_name(name: str) -> str:
+    """ Canonical key of a single name, see normalize_company_names. """
+    return normalize_company_names(pd.Series([name])).iloc[0]
+
+
+def find_exact_matches(results: pd.DataFrame, search_col: str = 'SearchTerm', name_col: str = 'BusinessName') -> pd.Series:
+    """
+        Returns a boolean mask of the rows in `results` whose `name_col` exactly matches their `search_col` after
+        normalization. All rows are matched in one go by joining on the (search term, normalized name) key, so this
+        works across the search results for a whole owner list.
+    """
+    # Each search term is normalized once, then hash joined against the normalized result names
+    terms = results[search_col].drop_duplicates()
+    term_keys = pd.DataFrame({'term': terms.to_numpy(), 'key': normalize_company_names(terms).to_numpy()})
+    rows = pd.DataFrame({'term': results[search_col].to_numpy(),
+                         'key': normalize_company_names(results[name_col]).to_numpy(),
+                         'row': range(len(results))})
+    matched_rows = rows.merge(term_keys, on=['term', 'key'], how='inner')['row'].to_numpy()
+
+    mask = pd.Series(False, index=results.index)
+    mask.iloc[matched_rows] = True
+    return mask
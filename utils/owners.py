@@ -7,10 +7,16 @@ import numpy as np
 import requests
 import json
 import os
-import re
-import geopandas as gp
 import urllib.parse
 
+from utils import instrument
+from utils.cache import ResponseCache, OfflineCacheMiss, cached_fetch
+from utils.export import ShardedExport
+from utils.fetch import FetchEngine
+from utils.grouping import group_companies
+from utils.names import find_exact_matches
+from utils.ranking import rank_potential_matches
+
 # Utils for finding principals
 
 search_for_business_url = 'https://cfda.sos.wa.gov/api/BusinessSearch/GetBusinessSearchList'
@@ -37,40 +43,54 @@ def get_business_search_payload(business_name, page_count, page_num):
         'PageCount': page_count,
     }
 
-def get_business_details(business_idL):
+business_details_url = 'https://cfda.sos.wa.gov/api/BusinessSearch/BusinessInformation'
+
+def get_business_details(business_id, cache: ResponseCache = None, engine: FetchEngine = None):
     """ Get business details from the Corporation and charities filing database. """
-    url = 'https://cfda.sos.wa.gov/api/BusinessSearch/BusinessInformation?businessID={business_id}'.format(business_id=business_id)
-    r = requests.get(url)
-    return json.loads(r.text)
+    url = '{base}?businessID={business_id}'.format(base=business_details_url, business_id=business_id)
+    request = (lambda: engine.get_json(url)) if engine is not None else (lambda: json.loads(requests.get(url).text))
+    return cached_fetch(cache, business_details_url, {'businessID': business_id}, request)
 
 
 class LookupCompaniesHelper:
-    def __init__(self, out_path: str):
+    def __init__(self, out_path: str, cache: ResponseCache = None, engine: FetchEngine = None, top_k: int = None):
         self.output_path = out_path
+        self.cache = cache # Optional ResponseCache shared by all registry calls
+        self.engine = engine if engine is not None else FetchEngine(max_workers=1) # Session, concurrency and rate limit for registry calls
+        self.top_k = top_k # Only keep the top_k best ranked potential matches per owner, see utils.ranking
+        self.failed_searches = set() # Owners whose search failed, their results are incomplete
 
     def _get_empty_df(self):
         return pd.DataFrame([], columns = ['SearchTerm', 'BusinessName', 'UBINumber', 'BusinessId', 
                                            'Address', 'Status', 'address_match', 'ubi_match', 'id_match'])
     
     def _get_business_search_results(self, business_name, page_num):
-        r = requests.post(search_for_business_url, get_business_search_payload(business_name, 100, page_num))
+        payload = get_business_search_payload(business_name, 100, page_num)
         try:
-            result = json.loads(r.text)
-        #return json.loads(r.text)
-        except:
+            result = cached_fetch(self.cache, search_for_business_url, payload,
+                                  lambda: self.engine.post_json(search_for_business_url, payload))
+        except OfflineCacheMiss:
+            # Not in the cache and we're offline, the next online run looks it up
+            print(f"Search for {business_name} (page {page_num}) isn't cached, skipping it while offline")
+            self.failed_searches.add(business_name)
+            result = {}
+        except Exception as e:
+            print(f"Search for {business_name} (page {page_num}) failed: {e!r}")
+            self.failed_searches.add(business_name)
             result = {}
         return result
 
     def _extract_search_results(self, search_term, search_req_response):
-        res_list = [[search_term, res['BusinessName'], res['UBINumber'], res['BusinessID'],
-                    res['PrincipalOffice']['PrincipalStreetAddress']['FullAddress'], res["BusinessStatus"]] 
-                    for res in search_req_response]
-        res_df = pd.DataFrame(res_list, columns=['SearchTerm', 'BusinessName', 'UBINumber', 'BusinessId', 'Address', "Status"])
-        # Basically keep a list of exact matches, and build a list of potential matches that we give to human verifiers
-        exact_match = res_df.index[res_df['BusinessName'] == search_term].tolist()
-        if exact_match:
-            res_df = pd.concat([res_df.iloc[[exact_match[0]],:], res_df.drop(exact_match[0], axis=0)], axis=0)
-        return res_df
+        with instrument.stage('extract_search_results', rows=len(search_req_response)):
+            res_list = [[search_term, res['BusinessName'], res['UBINumber'], res['BusinessID'],
+                        res['PrincipalOffice']['PrincipalStreetAddress']['FullAddress'], res["BusinessStatus"]] 
+                        for res in search_req_response]
+            res_df = pd.DataFrame(res_list, columns=['SearchTerm', 'BusinessName', 'UBINumber', 'BusinessId', 'Address', "Status"])
+            # Basically keep a list of exact matches, and build a list of potential matches that we give to human verifiers
+            exact_match = res_df.index[res_df['BusinessName'] == search_term].tolist()
+            if exact_match:
+                res_df = pd.concat([res_df.iloc[[exact_match[0]],:], res_df.drop(exact_match[0], axis=0)], axis=0)
+            return res_df
 
     def _determine_search_matches(self, search_results_df):
         """
@@ -83,16 +103,9 @@ class LookupCompaniesHelper:
         search_results_df['id_match'] = search_results_df.duplicated(subset=['BusinessId'], keep=False)
 
     def _get_all_company_name_match_search_results(self, owner_name):
-        n = 1
-        res_length = 100
-        search_results = []
-        
-        while res_length == 100:
-            res = self._get_business_search_results(owner_name, n)
-            search_results += (res)
-            n += 1
-            res_length = len(res)
-        
+        with instrument.stage('business_search_pagination') as stage:
+            search_results = self.engine.paginate(lambda n: self._get_business_search_results(owner_name, n), page_size=100)
+            stage.set(rows=len(search_results), pages=len(search_results) // 100 + 1)
         return search_results
 
     def _get_potential_company_name_matches(self, owner_name):
@@ -105,40 +118,22 @@ class LookupCompaniesHelper:
         """
             utils to separate search results into exact match, potential match (where no exact match was found), 
             and additional matches (extra matches if there was an exact match and additional matches)
+            `results` can hold the search results of any number of search terms, they're all separated at once.
+            Exact matches are found by comparing normalized names, see utils.names.normalize_company_names.
+            With `top_k` set, potential matches are ranked and cut down to the top_k most likely per search term.
         """
-        def is_exact_match(row):
-            """ Extract exact matches, including some regex magic. """
-            search = row["SearchTerm"]
-            result = row["BusinessName"]
-
-            # examples: LLC, LLP, L L C, L.L.C., L.L.C. L.L.P., L.L.P, LLC.
-            # Limited Partnership, Limited liability company
-            p = re.compile("L[\s.]?L[\s,.]?[PC][.]" ,flags=re.IGNORECASE)
-            result=result.replace(",", "")
-            result= re.sub(p, "LLC", result)
-            result=result.replace("LIMITED LIABILITY COMPANY", "LLC") 
-            result=result.replace("LIMITED PARTNERSHIP", "LLC") 
+        with instrument.stage('separate_search_results', rows=len(results)):
+            exact_match = find_exact_matches(results)
+            has_exact_match = exact_match.groupby(results['SearchTerm'].to_numpy()).transform('any').astype(bool)
 
-            search=search.replace(",", "")
-            search=re.sub(p, "LLC", search)
-            search=search.replace("LIMITED PARTNERSHIP", "LLC") 
-            search=search.replace("LIMITED LIABILITY COMPANY", "LLC") 
-
-            return search == result
-        
-        exact_matches = self._get_empty_df()
-        exact_matches.columns
-        potential_matches = self._get_empty_df()
-        additional_matches = self._get_empty_df()
-        
-        exact_match = results[results.apply(lambda row: is_exact_match(row))]
-        if len(exact_match) > 0:
-            exact_matches = pd.concat([exact_matches, exact_match], ignore_index=True)
-            additional_matches = pd.concat([additional_matches, results[results['SearchTerm'] != results['BusinessName']]], ignore_index=True)
-        else:
-            potential_matches = pd.concat([potential_matches, results], ignore_index=True)
-        
-        return exact_matches, potential_matches, additional_matches
+            exact_matches = pd.concat([self._get_empty_df(), results[exact_match]], ignore_index=True)
+            potential_matches = pd.concat([self._get_empty_df(), results[~has_exact_match]], ignore_index=True)
+            if self.top_k is not None:
+                potential_matches = rank_potential_matches(potential_matches, k=self.top_k)
+            additional_matches = pd.concat([self._get_empty_df(), 
+                                            results[has_exact_match & (results['SearchTerm'] != results['BusinessName'])]], 
+                                           ignore_index=True)
+            return exact_matches, potential_matches, additional_matches
 
     def get_company_list_name_matches(self, owner_list: list):
         """
@@ -148,35 +143,55 @@ class LookupCompaniesHelper:
             Potential_matches: when search term doesn't exactly match, there needs to be some human verification here to determine. 
             Additional_matches: extraneous matches in case potential_matches didn't yield enough results. 
         """
-        exact_matches = self._get_empty_df()
-        potential_matches = self._get_empty_df()
-        additional_matches = self._get_empty_df()
-        
-        for owner in owner_list:
-            matches = self._get_potential_company_name_matches(owner)
-            temp_exact, temp_potential, temp_add = self._separate_search_results(matches)
-            exact_matches = pd.concat([temp_exact, exact_matches], ignore_index=True)
-            potential_matches = pd.concat([temp_potential, potential_matches], ignore_index=True)
-            additional_matches = pd.concat([temp_add, additional_matches], ignore_index=True)
-        return exact_matches, potential_matches, additional_matches
+        all_matches = self.engine.map(self._get_potential_company_name_matches, owner_list)
+        # Latest owners first, like the results have always been ordered (get_company_matches_and_export keeps it)
+        matches = pd.concat([self._get_empty_df()] + all_matches[::-1], ignore_index=True)
+        return self._separate_search_results(matches)
     
 
-    def get_company_matches_and_export(self, owner_list: list, x: int):
+    def get_company_matches_and_export(self, owner_list: list, x: int, batch_size: int = 25):
         """
             Given a list of owners `owner_list` and batch number `x`, get all matches and save to exact, potential, and additional
             match CSV's in the folder determined by `output_path`
+            Matches are appended to `matches_{x}_parts/` every `batch_size` owners, so if a run is interrupted, calling this
+            again with the same `x` only looks up the owners that weren't finished. The parts are kept for the next run
+            until they are deleted. Owners whose search failed aren't checkpointed, so the next run retries them.
+            Only the rows of `owner_list` end up in the CSVs, even if the parts hold other owners from earlier runs.
         """
         print(f"Saving output files to {self.output_path}")
-        exact_matches, potential_matches, additional_matches = self.get_company_list_name_matches(owner_list)
-        
-        exact_matches.to_csv(f'{self.output_path}/exact_matches_{x}.csv')
-        potential_matches.to_csv(f'{self.output_path}/potential_matches_{x}.csv')
-        additional_matches.to_csv(f'{self.output_path}/additional_matches_{x}.csv')
+        outputs = ['exact_matches', 'potential_matches', 'additional_matches']
+        export = ShardedExport(self.output_path, f'matches_{x}', outputs, key_col='SearchTerm')
+
+        owners = list(dict.fromkeys(owner_list))
+        completed = export.completed()
+        remaining = [owner for owner in owners if owner not in completed]
+        if len(remaining) < len(owners):
+            print(f"Resuming, {len(remaining)} of {len(owners)} owners left")
+        self.failed_searches.difference_update(remaining)
+        for i in range(0, len(remaining), batch_size):
+            batch = remaining[i:i + batch_size]
+            with instrument.stage('owner_batch', owners=len(batch)):
+                matches = self.get_company_list_name_matches(batch)
+                # Failed owners are left out of the checkpoint, with their partial results
+                failed = self.failed_searches.intersection(batch)
+                matches = [df[~df['SearchTerm'].isin(failed)] for df in matches]
+                export.append([owner for owner in batch if owner not in failed], dict(zip(outputs, matches)))
+
+        # Latest owners first across batches too, the same order as get_company_list_name_matches
+        export.finalize({output: f'{self.output_path}/{output}_{x}.csv' for output in outputs},
+                        empty_columns=self._get_empty_df().columns, keys=owners[::-1])
+        failed = self.failed_searches.intersection(owners)
+        if failed:
+            print(f"{len(failed)} owner searches failed and are missing from the output, run again to retry them")
+        if instrument.instrumentation.enabled:
+            print(instrument.summary().to_string())
 
 class GroupCompaniesHelper:
-    def __init__(self, out_path: str, out_name: str):
+    def __init__(self, out_path: str, out_name: str, cache: ResponseCache = None, engine: FetchEngine = None):
         self.output_path = out_path # The path to the output file to save the output file
         self.output_name = out_name # The full name of the output file, eg. "companies_and_matches.csv"
+        self.cache = cache # Optional ResponseCache shared by all registry calls
+        self.engine = engine if engine is not None else FetchEngine(max_workers=1) # Session, concurrency and rate limit for registry calls
 
     def _extract_principals(self, business_res, business_id):
         """ Given a single JSON response for one business, return a dataframe for the given 
@@ -199,51 +214,40 @@ class GroupCompaniesHelper:
 
     def _get_principal_response(self, principal_name, page_num):
         data = self._get_principal_data(principal_name, page_num)
-        r = requests.post(principal_url, data=data, headers=principal_headers)
-        return json.loads(r.text)
+        return cached_fetch(self.cache, principal_url, data,
+                            lambda: self.engine.post_json(principal_url, data=data, headers=principal_headers))
 
     def _extract_principals_business(self, business_res, business_id, business_name):
         """
             Given a json of the business search result business_res and the business' id, 
             Create a dataframe of all the principals returned in business_res.
         """
-        agent = business_res['Agent']['EntityName']
-        rows = [[
-            business_res['UBINumber'],
-            business_id,
-            business_name,
-            agent,
-            'Entity' if principal['TypeID'] == 'E' else 'Individual',
-            principal['PrincipalID'],
-            principal['Name'] if principal['TypeID'] == 'E' else principal['FirstName'] + ' ' + principal['LastName'],
-            business_res['PrincipalOffice']['PrincipalStreetAddress']['FullAddress'],
-            business_res["BusinessStatus"]
-        ] for principal in business_res['PrincipalsList']]
-        return pd.DataFrame(rows, columns=['UBINumber', 'BusinessId', 'BusinessName', 'Agent', 'EntityType', 'PrincipalID', 'PrincipalName', "Address", "Status"])
+        with instrument.stage('extract_principals_business', rows=len(business_res['PrincipalsList'])):
+            agent = business_res['Agent']['EntityName']
+            rows = [[
+                business_res['UBINumber'],
+                business_id,
+                business_name,
+                agent,
+                'Entity' if principal['TypeID'] == 'E' else 'Individual',
+                principal['PrincipalID'],
+                principal['Name'] if principal['TypeID'] == 'E' else principal['FirstName'] + ' ' + principal['LastName'],
+                business_res['PrincipalOffice']['PrincipalStreetAddress']['FullAddress'],
+                business_res["BusinessStatus"]
+            ] for principal in business_res['PrincipalsList']]
+            return pd.DataFrame(rows, columns=['UBINumber', 'BusinessId', 'BusinessName', 'Agent', 'EntityType', 'PrincipalID', 'PrincipalName', "Address", "Status"])
 
     def _get_all_principal_search_results(self, principal_name):
-        n = 1
-        res_length = 100
-        search_results = []
-        
-        while res_length == 100:
-            res = self._get_principal_response(principal_name, n)
-            search_results += res
-            n += 1
-            res_length = len(res)
-        
+        with instrument.stage('principal_search_pagination') as stage:
+            search_results = self.engine.paginate(lambda n: self._get_principal_response(principal_name, n), page_size=100)
+            stage.set(rows=len(search_results), pages=len(search_results) // 100 + 1)
         return search_results
 
-    def _get_all_companies_from_principal_dataframe(self, principal_match_list, principal_name):
-        """ Returns every row in `principal_match_list` where the business has `principal_name` listed as a principal. """
-        companies_with_same_principal = principal_match_list[principal_match_list['PrincipalName'] == principal_name].BusinessId.unique()
-        return principal_match_list[principal_match_list["BusinessId"].isin(companies_with_same_principal)]
-
     def _get_all_companies_from_principal_lookup(self, principal_name):
         """
             [DEPRECATED] Looks up principal name in the CDFA database and returns all companies in the results as a dataframe. 
             This doesn't filter by region of interest (eg. companies in the results might not be relevant to our grouping exercise).
-            To limit the lookup of companies by principal to the companies we care about see, get_all_companies_from_principal_dataframe
+            To limit the grouping to the companies we care about see, group_companies_by_principals
         """
         # should include company name, see below
         principals = pd.DataFrame([], columns=['UBINumber', 'BusinessId', 'BusinessName', 'Agent', 'EntityType', 'PrincipalID', 'PrincipalName'])
@@ -257,8 +261,8 @@ class GroupCompaniesHelper:
         business_names = [res['BusinessName'] for res in search_results]
         ubi_nums = [res['UBINumber'] for res in search_results]
         
-        for id, name in zip(business_ids, business_names):
-            business_json = get_business_details(id)
+        all_business_json = self.engine.map(lambda id: get_business_details(id, self.cache, self.engine), business_ids)
+        for id, name, business_json in zip(business_ids, business_names, all_business_json):
             principals_df = self._extract_principals_business(business_json, id, name)
             
             if len(principals_df[principals_df['PrincipalName'] == principal_name]) > 0:
@@ -273,50 +277,27 @@ class GroupCompaniesHelper:
             for that company in the returned dataframe. 
         '''
         principals = pd.DataFrame([], columns=['BusinessId', 'Agent', 'EntityType', 'PrincipalID', 'PrincipalName'])
-        for business in business_names_df['BusinessId']:
-            business_res = get_business_details(business)
+        # Each business is only looked up once, even if it's listed several times in business_names_df
+        business_ids = business_names_df['BusinessId'].drop_duplicates().tolist()
+        all_business_res = self.engine.map(lambda id: get_business_details(id, self.cache, self.engine), business_ids)
+        for business, business_res in zip(business_ids, all_business_res):
             principals = pd.concat([self._extract_principals(business_res, business), principals], ignore_index=True)
         
         merged_principals = pd.merge(business_names_df, principals, on='BusinessId', how='left')
         
         return merged_principals
 
-    def group_companies_by_principals(self, principal_match_list: pd.DataFrame):
+    def group_companies_by_principals(self, principal_match_list: pd.DataFrame, link_on=('PrincipalName',)):
         """
             Given a list of businesses with one line for each principal registered for that business, returns 
             a dataframe where companies are grouped by whether they share a principal. 
+            Companies are grouped transitively, see utils.grouping.group_companies. `link_on` can add 'Agent' and/or
+            'Address' to also group companies with the same registered agent or address.
             
             principal_match_list is an output from previous steps, like the dataframe `all_matches_principals.csv`
         """
         print(f"Saving to {self.output_path}{self.output_name}")
-        columns=['SearchTerm', 'BusinessName', 'PotentialRelatedCompany', 'UBINumber', 'BusinessId', 'Address', 
-                'Status', 'Agent', 'Principals', 'isMatch', 'notes']
-        results = pd.DataFrame([], columns)
-        for idx, row in principal_match_list.iterrows():
-            possible_matching_companies_df = self._get_all_companies_from_principal_dataframe(principal_match_list, row['PrincipalName'])
-            grouped = possible_matching_companies_df.groupby("BusinessName")
-            for name, group in grouped:
-                principals_list = group["PrincipalName"].tolist()
-                principals_list.sort()
-                poss_company = group.iloc[0]
-
-                # row['BusinessName']: the name we mapped to from SearchTerm
-                # poss_company['BusinessName]: PotentialRelatedCompany
-                new_row = pd.Series(data=[row['SearchTerm'], 
-                                row["BusinessName"], 
-                                poss_company["BusinessName"],
-                                poss_company['UBINumber'],
-                                poss_company["BusinessId"],
-                                poss_company["Address"],
-                                poss_company["Status"],
-                                poss_company["Agent"],
-                                principals_list,
-                                "", # isMatch
-                                ""  # Notes
-                                ], 
-                            index = columns)
-                results = pd.concat([new_row.to_frame().T, results], ignore_index=True).drop_duplicates(subset="UBINumber").dropna()
-            if(idx % 25 == 0): 
-                print(f"Processing row {idx} of principal_match_list, results is {len(results)}")
-                results.to_csv(f"{self.output_path}{self.output_name}")
-        return results
\ No newline at end of file
+        with instrument.stage('group_companies', rows=len(principal_match_list)):
+            results = group_companies(principal_match_list, link_on)
+        results.to_csv(f"{self.output_path}{self.output_name}")
+        return results
@@ -0,0 +1,114 @@
+"""
+    Per building emissions projections against the city's greenhouse gas intensity targets (GHGITs),
+    see experiments/benchmarks/emissions_regs_cleaned.csv.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Compliance intervals of the GHGITs and how many years of emissions each one covers
+periods = ['2027-2030', '2031-2035', '2036-2040', '2041-2045', '2046-']
+period_years = np.array([4, 5, 5, 5, 1])
+# Years of emissions at current intensity before the first compliance interval
+baseline_years = 3
+
+
+def load_targets(path: str = 'experiments/benchmarks/emissions_regs_cleaned.csv') -> pd.DataFrame:
+    """
+        Reads the GHGIT table, indexed by building activity type (which matches LegislationPropertyType) with one
+        column per compliance interval. Intervals without a target, eg. Multifamily Housing in 2027-2030, are NaN.
+    """
+    targets = pd.read_csv(path, index_col=0).set_index('Building Activity Type')[periods]
+    return targets.apply(pd.to_numeric, errors='coerce')
+
+
+class EmissionsProjection:
+    """
+        Projected emissions of every building, for every compliance interval and every scenario.
+        Arrays are shaped (buildings, periods, scenarios), with buildings in the order of the input dataframe.
+
+        target: the building's intensity target under each scenario (kgCO2e/sf/yr), NaN where there is no target.
+        gap: how far the building's current intensity is above the target, 0 when it already complies.
+        required_reduction: the gap as a fraction of the building's current intensity.
+        intensity: projected intensity, the building's current intensity capped at the target.
+        emissions: projected emissions over the whole interval (kgCO2e), intensity * GFA * years in the interval.
+        baseline: emissions at current intensity before the first interval, shaped (buildings,).
+    """
+    def __init__(self, index, periods, scenarios, target, gap, required_reduction, intensity, emissions, baseline):
+        self.index = index
+        self.periods = list(periods)
+        self.scenarios = np.asarray(scenarios)
+        self.target = target
+        self.gap = gap
+        self.required_reduction = required_reduction
+        self.intensity = intensity
+        self.emissions = emissions
+        self.baseline = baseline
+
+    def totals(self, groups: pd.Series = None, values: str = 'emissions') -> pd.DataFrame:
+        """
+            Sums `values` (eg. 'emissions' or 'gap') over the buildings in each of `groups` (eg. the buildings'
+            LegislationPropertyType), or over all buildings. Returns a frame indexed by group with a
+            (period, scenario) column for every combination.
+        """
+        arr = np.nan_to_num(getattr(self, values))
+        n_buildings, n_periods, n_scenarios = arr.shape
+        flat = arr.reshape(n_buildings, n_periods * n_scenarios)
+        if groups is None:
+            codes, uniques = np.zeros(n_buildings, dtype=np.int64), pd.Index(['All Buildings'])
+        else:
+            codes, uniques = pd.factorize(pd.Series(groups).to_numpy())
+        sums = np.zeros((len(uniques), flat.shape[1]))
+        valid = codes >= 0
+        np.add.at(sums, codes[valid], flat[valid])
+        columns = pd.MultiIndex.from_product([self.periods, self.scenarios], names=['period', 'scenario'])
+        return pd.DataFrame(sums, index=uniques, columns=columns)
+
+    def to_frame(self) -> pd.DataFrame:
+        """ Long format: one row per building, period and scenario. """
+        n_buildings, n_periods, n_scenarios = self.emissions.shape
+        return pd.DataFrame({
+            'building': np.repeat(np.asarray(self.index), n_periods * n_scenarios),
+            'period': np.tile(np.repeat(self.periods, n_scenarios), n_buildings),
+            'scenario': np.tile(self.scenarios, n_buildings * n_periods),
+            'target': self.target.ravel(),
+            'gap': self.gap.ravel(),
+            'required_reduction': self.required_reduction.ravel(),
+            'intensity': self.intensity.ravel(),
+            'emissions': self.emissions.ravel(),
+        })
+
+
+def project_emissions(buildings: pd.DataFrame, targets: pd.DataFrame, decrease_percents=(0,),
+                      type_col: str = 'LegislationPropertyType', intensity_col: str = 'GHGEmissionsIntensity',
+                      gfa_col: str = 'PropertyGFABuilding(s)') -> EmissionsProjection:
+    """
+        Projects every building in `buildings` against `targets` (see load_targets) under every scenario in
+        `decrease_percents`, where a scenario tightens every target by that many percent (like the additional
+        emissions intensity decrease percent in benchmarking_targets.ipynb).
+        The BigQuery copy of the data spells the GFA column `PropertyGFABuilding_s_`, pass `gfa_col` accordingly.
+        Buildings whose type has no targets keep their current intensity.
+    """
+    target_table = targets.reindex(columns=periods).to_numpy(dtype=float)
+    type_codes = targets.index.get_indexer(buildings[type_col])
+
+    # (buildings, periods), rows of unknown types are all NaN
+    building_targets = np.full((len(buildings), len(periods)), np.nan)
+    known = type_codes >= 0
+    building_targets[known] = target_table[type_codes[known]]
+
+    scale = 1 - np.asarray(decrease_percents, dtype=float) / 100
+    target = building_targets[:, :, None] * scale[None, None, :]
+
+    current = pd.to_numeric(buildings[intensity_col], errors='coerce').to_numpy(dtype=float)[:, None, None]
+    gfa = pd.to_numeric(buildings[gfa_col], errors='coerce').to_numpy(dtype=float)[:, None, None]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gap = np.where(np.isnan(target), 0, np.maximum(current - target, 0))
+        required_reduction = np.where(current > 0, gap / current, 0)
+        intensity = np.where(np.isnan(target), current, np.minimum(current, target))
+    emissions = intensity * gfa * period_years[None, :, None]
+    baseline = current[:, 0, 0] * gfa[:, 0, 0] * baseline_years
+
+    return EmissionsProjection(buildings.index, periods, decrease_percents, target, gap, required_reduction,
+                               intensity, emissions, baseline)
@@ -0,0 +1,109 @@
+"""
+    Ranking of potential company matches, so volunteers verifying owners only look at the most likely candidates
+    instead of every `Contains` search result.
+
+    Names are compared by their character n-grams (after normalize_company_names), with an inverted index from
+    n-gram to names. Only names sharing at least one n-gram with a query are ever scored, so ranking a whole owner
+    list costs about the number of shared n-grams rather than owners x results.
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils import instrument
+from utils.names import normalize_company_names
+
+# Added to the name similarity of a search result when the signals from _determine_search_matches are set
+signal_boosts = {'address_match': 0.1, 'ubi_match': 0.05, 'id_match': 0.05}
+
+
+def name_ngrams(keys: pd.Series, n: int = 3) -> pd.DataFrame:
+    """
+        One row per distinct (position in `keys`, n-gram) of the already normalized names in `keys`.
+        Names are padded with a space on both sides, so short names and word starts and ends get n-grams too.
+    """
+    padded = (' ' + keys.astype(str) + ' ').tolist()
+    grams = pd.DataFrame({'row': np.arange(len(padded)),
+                          'gram': [[key[i:i + n] for i in range(max(1, len(key) - n + 1))] for key in padded]})
+    return grams.explode('gram').drop_duplicates(ignore_index=True)
+
+
+class NgramIndex:
+    """
+        Inverted index from character n-gram to the names in `names`, optionally split into `blocks` (eg. the search
+        term each result came from) so a query only ever sees names from its own block.
+
+        max_df: n-grams in more than this fraction of the names (like the ones in LLC) are left out of the index and
+            the scores. They'd make every name a candidate without telling them apart.
+    """
+    def __init__(self, names: pd.Series, blocks: pd.Series = None, n: int = 3, max_df: float = None):
+        self.n = n
+        self.names = names.reset_index(drop=True)
+        grams = name_ngrams(normalize_company_names(self.names), n)
+        grams['block'] = '' if blocks is None else blocks.astype(str).to_numpy()[grams['row'].to_numpy()]
+
+        self.stop_grams = set()
+        if max_df is not None:
+            frequency = grams.groupby('gram')['row'].nunique() / max(1, len(self.names))
+            self.stop_grams = set(frequency.index[frequency > max_df])
+            grams = grams[~grams['gram'].isin(self.stop_grams)]
+        self.postings = grams
+        self.sizes = np.bincount(grams['row'].to_numpy(dtype=np.int64), minlength=len(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def query(self, names: pd.Series, blocks: pd.Series = None, k: int = 10) -> pd.DataFrame:
+        """
+            The `k` indexed names most similar to each name in `names` (all the ones sharing an n-gram when k is None).
+            Returns a dataframe with the position of the query in `names` (`query`), the position of the indexed name
+            (`row`) and their Dice similarity over n-grams (`score`, 1 for identical names), best first per query.
+        """
+        names = names.reset_index(drop=True)
+        grams = name_ngrams(normalize_company_names(names), self.n)
+        grams['block'] = '' if blocks is None else blocks.astype(str).to_numpy()[grams['row'].to_numpy()]
+        grams = grams[~grams['gram'].isin(self.stop_grams)].rename(columns={'row': 'query'})
+        query_sizes = grams.groupby('query').size()
+
+        # Hash join on (block, n-gram) finds every indexed name sharing an n-gram, and how many it shares
+        shared = (grams.merge(self.postings, on=['block', 'gram'], how='inner')
+                       .groupby(['query', 'row'], sort=False).size().rename('shared').reset_index())
+        shared['score'] = 2 * shared['shared'] / (query_sizes.reindex(shared['query']).to_numpy()
+                                                  + self.sizes[shared['row'].to_numpy()])
+        ranked = shared.sort_values(['query', 'score'], ascending=[True, False], kind='stable')
+        if k is not None:
+            ranked = ranked.groupby('query', sort=False).head(k)
+        return ranked[['query', 'row', 'score']].reset_index(drop=True)
+
+
+def rank_potential_matches(results: pd.DataFrame, k: int = 10, n: int = 3, boosts: dict = None,
+                           search_col: str = 'SearchTerm', name_col: str = 'BusinessName') -> pd.DataFrame:
+    """
+        Scores every search result against its own search term and keeps the `k` best per search term (all of them
+        when k is None), with their `match_score` and `match_rank` (1 for the best). Search terms keep their order,
+        and the results of each are sorted best first.
+        The score is the n-gram similarity of the names plus `boosts` (signal_boosts by default) for each of the
+        address_match, ubi_match and id_match signals that's set.
+    """
+    boosts = signal_boosts if boosts is None else boosts
+    with instrument.stage('rank_potential_matches', rows=len(results)) as stage:
+        results = results.reset_index(drop=True)
+        index = NgramIndex(results[name_col], blocks=results[search_col], n=n)
+        terms = results[search_col].drop_duplicates().reset_index(drop=True)
+        hits = index.query(terms, blocks=terms, k=None)
+
+        # Results that don't share an n-gram with their search term keep a name score of 0
+        score = np.zeros(len(results))
+        score[hits['row'].to_numpy()] = hits['score'].to_numpy()
+        for col, boost in boosts.items():
+            if col in results.columns:
+                score += boost * results[col].fillna(False).astype(bool).to_numpy()
+
+        # Search terms stay in the order they came in
+        ranked = results.assign(match_score=score, _term=pd.factorize(results[search_col])[0])
+        ranked = ranked.sort_values(['_term', 'match_score'], ascending=[True, False], kind='stable').drop(columns='_term')
+        ranked['match_rank'] = ranked.groupby(search_col, sort=False).cumcount() + 1
+        if k is not None:
+            ranked = ranked[ranked['match_rank'] <= k]
+        stage.set(kept=len(ranked), candidates=len(hits))
+        return ranked.reset_index(drop=True)
@@ -0,0 +1,202 @@
+"""
+    Precomputed emissions and energy totals by landlord, council district, LegislationPropertyType and year, so
+    rankings like largest_landlords_and_energy_use.csv or the worst_offenders tables don't need a notebook group-by
+    over the whole benchmark table every time.
+
+        cube = RollupCube(landlord_map(grouped))    # grouped: GroupCompaniesHelper output
+        cube.update(buildings)                      # rows of the benchmark table, any number of years
+        cube.rank('TotalGHGE', n=20)                # biggest emitting landlords
+        cube.rollup(['CouncilDistrictCode'], DataYear=2020)
+
+    Only sums and counts are stored, so any coarser grouping is a sum over the cube's cells. Averages are derived
+    from them when a rollup is read.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import instrument
+from utils.names import normalize_company_names
+
+dimensions = ['Landlord', 'CouncilDistrictCode', 'LegislationPropertyType', 'DataYear']
+
+# Summed measures and the columns they come from, the csv exports and the BigQuery table spell them differently
+measure_columns = {
+    'TotalGHGE': ['TotalGHGEmissions (metric tons)', 'TotalGHGEmissions__metric_tons_'],
+    'TotalElectricity_kBtu': ['Electricity(kBtu)', 'Electricity_kBtu_'],
+    'TotalNaturalGas_kBtu': ['NaturalGas(kBtu)', 'NaturalGas_kBtu_'],
+    'TotalSteamUse_kBtu': ['SteamUse(kBtu)', 'SteamUse_kBtu_'],
+    'TotalOtherFuelUse_kBtu': ['OtherFuelUse(kBtu)', 'OtherFuelUse_kBtu_'],
+    'TotalSiteEnergyUse_kBtu': ['SiteEnergyUse(kBtu)', 'SiteEnergyUse_kBtu_'],
+    'TotalSquareFootage': ['PropertyGFATotal'],
+    'ENERGYSTARScoreSum': ['ENERGYSTARScore'],
+}
+# Buildings in the cell, and how many of them have an ENERGY STAR score (for the average)
+count_columns = ['BuildingsOwned', 'ENERGYSTARScoreCount']
+
+# What a missing dimension value is stored as, so those buildings still count towards the totals
+unknown_values = {'Landlord': 'UNKNOWN', 'CouncilDistrictCode': -1, 'LegislationPropertyType': 'UNKNOWN', 'DataYear': -1}
+
+
+def landlord_map(grouped: pd.DataFrame) -> pd.Series:
+    """
+        Normalized company name -> landlord, from companies grouped by shared principals (see
+        utils.grouping.group_companies). Every company in a group, and the owner name it was found from, maps to the
+        group's hub BusinessName. Filter `grouped` on isMatch first to only use verified matches.
+    """
+    names = pd.concat([grouped['PotentialRelatedCompany'], grouped['SearchTerm']], ignore_index=True)
+    hubs = pd.concat([grouped['BusinessName'], grouped['BusinessName']], ignore_index=True)
+    landlords = pd.Series(hubs.to_numpy(), index=normalize_company_names(names).to_numpy())
+    return landlords[~landlords.index.duplicated(keep='first')]
+
+
+def assign_landlords(owners: pd.Series, landlords: pd.Series = None) -> pd.Series:
+    """
+        Landlord of every building owner in `owners`. Owners listed together ('A LLC+B LLC') are looked up by the
+        first of them. Owners that aren't in `landlords` are their own landlord.
+    """
+    keys = normalize_company_names(owners)
+    first = normalize_company_names(owners.astype('string').str.split('+').str[0])
+    result = keys.where(keys != '')
+    if landlords is not None and len(landlords):
+        result = keys.map(landlords).fillna(first.map(landlords)).fillna(result)
+    return result.fillna(unknown_values['Landlord'])
+
+
+def with_averages(totals: pd.DataFrame) -> pd.DataFrame:
+    """ Adds the averages derived from summed measures: ENERGY STAR score and GHG intensity (kgCO2e/sf). """
+    totals = totals.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        totals['AverageENERGYSTARScore'] = totals['ENERGYSTARScoreSum'] / totals['ENERGYSTARScoreCount']
+        totals['GHGEmissionsIntensity'] = totals['TotalGHGE'] * 1000 / totals['TotalSquareFootage'].replace(0, np.nan)
+    return totals
+
+
+class RollupCube:
+    """
+        Sums of `measure_columns` and building counts for every (Landlord, CouncilDistrictCode,
+        LegislationPropertyType, DataYear) cell with at least one building.
+
+        Each building's contribution is kept in `facts` (one row per OSEBuildingID and DataYear, the building's key),
+        so new or corrected buildings, ownership changes and new years only recompute the cells they touch.
+    """
+    def __init__(self, landlords: pd.Series = None):
+        self.landlords = landlords
+        self.facts = self._facts(pd.DataFrame(columns=['OSEBuildingID', 'DataYear']))
+        self.cells = self._aggregate(self.facts)
+
+    @staticmethod
+    def _keys(df: pd.DataFrame) -> pd.MultiIndex:
+        return pd.MultiIndex.from_arrays([df['OSEBuildingID'].to_numpy(), df['DataYear'].to_numpy()])
+
+    def _facts(self, buildings: pd.DataFrame) -> pd.DataFrame:
+        """ The contribution of every building in `buildings` to its cell. """
+        facts = pd.DataFrame({'OSEBuildingID': buildings['OSEBuildingID'].to_numpy()})
+        facts['Owner'] = buildings['Owner'].to_numpy() if 'Owner' in buildings.columns else None
+        facts['Landlord'] = assign_landlords(facts['Owner'], self.landlords).to_numpy()
+        for dim in ['CouncilDistrictCode', 'LegislationPropertyType', 'DataYear']:
+            values = buildings[dim] if dim in buildings.columns else pd.Series(np.nan, index=buildings.index)
+            facts[dim] = values.fillna(unknown_values[dim]).to_numpy()
+        facts['CouncilDistrictCode'] = facts['CouncilDistrictCode'].astype(np.int64)
+
+        for measure, columns in measure_columns.items():
+            column = next((col for col in columns if col in buildings.columns), None)
+            values = pd.to_numeric(buildings[column], errors='coerce') if column else pd.Series(np.nan, index=buildings.index)
+            facts[measure] = values.fillna(0).to_numpy(dtype=float)
+            if measure == 'ENERGYSTARScoreSum':
+                facts['ENERGYSTARScoreCount'] = values.notna().to_numpy(dtype=np.int64)
+        return facts[~self._keys(facts).duplicated(keep='last')].reset_index(drop=True)
+
+    @staticmethod
+    def _aggregate(facts: pd.DataFrame) -> pd.DataFrame:
+        sums = facts.groupby(dimensions, sort=False)[list(measure_columns) + ['ENERGYSTARScoreCount']].sum()
+        sums.insert(0, 'BuildingsOwned', facts.groupby(dimensions, sort=False).size().astype(np.int64))
+        return sums
+
+    def _refresh(self, cells: pd.MultiIndex):
+        """ Recomputes `cells` from the facts, dropping the ones left without buildings. """
+        if len(cells) == 0:
+            return
+        cells = cells.unique()
+        refreshed = self._aggregate(self.facts[self._cells_of(self.facts).isin(cells)])
+        self.cells = pd.concat([self.cells[~self.cells.index.isin(cells)], refreshed])
+
+    @staticmethod
+    def _cells_of(facts: pd.DataFrame) -> pd.MultiIndex:
+        return pd.MultiIndex.from_frame(facts[dimensions])
+
+    def update(self, buildings: pd.DataFrame) -> int:
+        """
+            Adds the buildings in `buildings`, or replaces them when they're already in the cube (same OSEBuildingID
+            and DataYear). Returns how many cells were recomputed.
+        """
+        with instrument.stage('rollup_update', rows=len(buildings)) as stage:
+            new = self._facts(buildings)
+            replaced = self._keys(self.facts).isin(self._keys(new))
+            affected = self._cells_of(self.facts[replaced]).append(self._cells_of(new)).unique()
+            self.facts = pd.concat([self.facts[~replaced], new], ignore_index=True)
+            self._refresh(affected)
+            stage.set(cells=len(affected))
+        return len(affected)
+
+    def remove(self, keys) -> int:
+        """ Removes the buildings with the (OSEBuildingID, DataYear) `keys`. Returns how many cells were recomputed. """
+        removed = self._keys(self.facts).isin(pd.MultiIndex.from_tuples(list(keys)))
+        affected = self._cells_of(self.facts[removed]).unique()
+        self.facts = self.facts[~removed].reset_index(drop=True)
+        self._refresh(affected)
+        return len(affected)
+
+    def set_landlords(self, landlords: pd.Series) -> int:
+        """
+            Switches to a new owner -> landlord mapping (eg. after more companies were grouped). Only buildings whose
+            landlord changed move, returns how many cells were recomputed.
+        """
+        self.landlords = landlords
+        relabeled = assign_landlords(self.facts['Owner'], landlords).to_numpy()
+        moved = self.facts['Landlord'].to_numpy() != relabeled
+        before = self._cells_of(self.facts[moved])
+        self.facts.loc[moved, 'Landlord'] = relabeled[moved]
+        affected = before.append(self._cells_of(self.facts[moved])).unique()
+        self._refresh(affected)
+        return len(affected)
+
+    def rollup(self, by=('Landlord',), **filters) -> pd.DataFrame:
+        """
+            Totals grouped by the dimensions in `by` (an empty `by` gives the grand total), over the cells matching
+            `filters`, eg. rollup(['Landlord', 'DataYear'], CouncilDistrictCode=[3, 4]). A filter is a value or a
+            list of values. Averages are derived from the summed cells, see with_averages.
+        """
+        cells = self.cells.reset_index()
+        for dim, value in filters.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            cells = cells[cells[dim].isin(values)]
+        measures = count_columns + list(measure_columns)
+        if by:
+            totals = cells.groupby(list(by))[measures].sum()
+        else:
+            totals = cells[measures].sum().to_frame('All Buildings').T
+        return with_averages(totals)
+
+    def rank(self, measure: str = 'TotalGHGE', by=('Landlord',), n: int = 20, ascending: bool = False,
+             **filters) -> pd.DataFrame:
+        """ The top `n` groups by `measure`, eg. rank('TotalGHGE', DataYear=2020) for the biggest emitting landlords. """
+        totals = self.rollup(by, **filters)
+        return totals.sort_values(measure, ascending=ascending).head(n)
+
+    def save(self, path: str):
+        """ Writes the facts to `path` (a Parquet file), the cells are rebuilt from them by `load`. Needs pyarrow. """
+        self.facts.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str, landlords: pd.Series = None) -> 'RollupCube':
+        """ Cube saved with `save`. With `landlords`, buildings are relabeled with it. """
+        cube = cls(landlords)
+        cube.facts = pd.read_parquet(path)
+        if landlords is not None:
+            cube.facts['Landlord'] = assign_landlords(cube.facts['Owner'], landlords).to_numpy()
+        cube.cells = cube._aggregate(cube.facts)
+        return cube
@@ -0,0 +1,107 @@
+"""
+    Local snapshots of BigQuery query results, so notebooks don't re-download the building benchmark table on every run.
+    Snapshots are stored as Parquet files and need pyarrow.
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+
+import pandas as pd
+
+from utils.store import load
+
+project_id = 'seattle-377109'
+building_benchmark_query = """
+    SELECT *
+    FROM `GHGE_buildings_data.building-benchmark`;
+"""
+
+
+def read_gbq(query: str) -> pd.DataFrame:
+    """ Default backend: runs `query` on BigQuery with pandas_gbq. """
+    import pandas_gbq
+    return pandas_gbq.read_gbq(query, project_id=project_id)
+
+
+def query_key(query: str) -> str:
+    """ Snapshot key of a query, whitespace differences between otherwise identical queries don't matter. """
+    normalized = re.sub(r'\s+', ' ', query).strip().rstrip(';').strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+class SnapshotCache:
+    """
+        Read-through cache of query results.
+
+        snapshot_dir: where snapshots are stored, one `{key}.parquet` plus `{key}.json` (query and fetch time) per query.
+        backend: function running a query and returning a dataframe, read_gbq by default. Any stand-in with the same
+            signature works, eg. for testing or reading from a local csv export.
+        max_age: seconds a snapshot is used before it's fetched again, None to keep snapshots until invalidated.
+    """
+    def __init__(self, snapshot_dir: str = 'bq_snapshots', backend=read_gbq, max_age: float = None):
+        self.snapshot_dir = snapshot_dir
+        self.backend = backend
+        self.max_age = max_age
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    def _paths(self, query):
+        key = query_key(query)
+        return os.path.join(self.snapshot_dir, f'{key}.parquet'), os.path.join(self.snapshot_dir, f'{key}.json')
+
+    def info(self, query: str) -> dict:
+        """ Metadata of the query's snapshot (query, fetched_at, rows, columns), None if there isn't one. """
+        data_path, meta_path = self._paths(query)
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def is_fresh(self, query: str, max_age: float = None) -> bool:
+        info = self.info(query)
+        if info is None:
+            return False
+        max_age = self.max_age if max_age is None else max_age
+        return max_age is None or time.time() - info['fetched_at'] < max_age
+
+    def refresh(self, query: str):
+        """ Runs the query on the backend and replaces its snapshot. """
+        data_path, meta_path = self._paths(query)
+        df = self.backend(query)
+        # Write to temporary files first so a failed write never leaves a half written snapshot behind
+        df.to_parquet(data_path + '.tmp', index=False)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'query': query, 'fetched_at': time.time(), 'rows': len(df), 'columns': list(df.columns)}, f)
+        os.replace(data_path + '.tmp', data_path)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def read(self, query: str, columns: list = None, filters: list = None, max_age: float = None,
+             refresh: bool = False) -> pd.DataFrame:
+        """
+            Returns the result of `query`, from its snapshot when there's a fresh one.
+            columns: only read these columns from the snapshot.
+            filters: row filters applied while reading the snapshot, eg. [('DataYear', '==', 2020)].
+            max_age: overrides the cache's max_age for this read.
+            refresh: always fetch from the backend.
+            The full query result is snapshotted, `columns` and `filters` only apply locally.
+        """
+        if refresh or not self.is_fresh(query, max_age):
+            self.refresh(query)
+        return load(self._paths(query)[0], columns=columns, filters=filters)
+
+    def invalidate(self, query: str = None):
+        """ Deletes the snapshot of `query`, or every snapshot when no query is given. """
+        if query is None:
+            paths = [os.path.join(self.snapshot_dir, f) for f in os.listdir(self.snapshot_dir)]
+        else:
+            paths = self._paths(query)
+        for path in paths:
+            if os.path.exists(path) and path.endswith(('.parquet', '.json')):
+                os.remove(path)
+
+
+def read_building_benchmark(cache: SnapshotCache, columns: list = None, filters: list = None, **kwargs) -> pd.DataFrame:
+    """ The `GHGE_buildings_data.building-benchmark` table, read through `cache`. """
+    return cache.read(building_benchmark_query, columns=columns, filters=filters, **kwargs)
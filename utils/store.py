@@ -0,0 +1,95 @@
+"""
+    Columnar (Parquet) storage for the chunked owner search and principals datasets, eg.
+    data/building_owners/initial_owner_search/owner_search_chunk_*.csv and principals/principals_search_chunk_*.csv.
+    Needs pyarrow.
+"""
+
+import glob
+import re
+
+import pandas as pd
+
+# Explicit types for every column the owner lookup steps produce. Names, addresses and agents repeat on every
+# principal row of a business (and often across businesses), so they're stored as categoricals.
+ownership_dtypes = {
+    'SearchTerm': 'category',
+    'BusinessName': 'category',
+    'PotentialRelatedCompany': 'category',
+    'UBINumber': 'string',
+    'BusinessId': 'Int64',
+    'Address': 'category',
+    'Status': 'category',
+    'address_match': 'boolean',
+    'ubi_match': 'boolean',
+    'id_match': 'boolean',
+    'isMatch': 'boolean',
+    'Agent': 'category',
+    'EntityType': 'category',
+    'PrincipalID': 'Int64',
+    'PrincipalName': 'category',
+    'notes': 'string',
+}
+
+# The same columns have been spelled a few ways across the chunk files
+column_renames = {'IsMatch': 'isMatch', 'is_match': 'isMatch'}
+
+
+def normalize_ubi(ubi: pd.Series) -> pd.Series:
+    """ Normalizes UBI numbers (eg. '604 268 117', '604-268-117', 604268117.0) to their 9 digit string form. """
+    digits = ubi.astype('string').str.replace(r'\.0$', '', regex=True).str.replace(r'\D', '', regex=True)
+    return digits.where(digits.str.len() > 0).str.zfill(9)
+
+
+def normalize_match_flags(flags: pd.Series) -> pd.Series:
+    """ The isMatch verification flag (1/0, True/False or blank for not reviewed yet) as a nullable boolean. """
+    text = flags.astype('string').str.strip().str.lower()
+    return text.map({'1': True, '1.0': True, 'true': True, '0': False, '0.0': False, 'false': False}).astype('boolean')
+
+
+def apply_ownership_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """ Renames, drops the saved csv index and casts the known columns of an owner search dataframe. """
+    df = df.rename(columns=column_renames)
+    df = df.drop(columns=[c for c in df.columns if c == '' or c.startswith('Unnamed:')])
+    if 'UBINumber' in df.columns:
+        df['UBINumber'] = normalize_ubi(df['UBINumber'])
+    if 'isMatch' in df.columns:
+        df['isMatch'] = normalize_match_flags(df['isMatch'])
+    return df.astype({col: dtype for col, dtype in ownership_dtypes.items() if col in df.columns})
+
+
+def _chunk_number(path):
+    numbers = re.findall(r'\d+', path)
+    return int(numbers[-1]) if numbers else -1
+
+
+def read_csv_chunks(pattern: str) -> pd.DataFrame:
+    """
+        Reads every csv chunk matching the glob `pattern`, in chunk number order, into one typed dataframe.
+        The chunk number is kept in a `chunk` column.
+    """
+    paths = sorted(glob.glob(pattern), key=_chunk_number)
+    if not paths:
+        raise FileNotFoundError(f'No files match {pattern}')
+    # Casting after concatenating, so categoricals share one set of categories across chunks
+    df = pd.concat([pd.read_csv(path).assign(chunk=_chunk_number(path)) for path in paths], ignore_index=True)
+    df = apply_ownership_dtypes(df)
+    df['chunk'] = df['chunk'].astype('int16')
+    return df
+
+
+def convert_csv_chunks(pattern: str, out_path: str) -> pd.DataFrame:
+    """ Converts the csv chunks matching `pattern` into a single Parquet file at `out_path`, returns the data. """
+    df = read_csv_chunks(pattern)
+    df.to_parquet(out_path, index=False)
+    return df
+
+
+def load(path: str, columns: list = None, filters: list = None, memory_map: bool = True) -> pd.DataFrame:
+    """
+        Loads a dataset written by convert_csv_chunks.
+        columns: only read these columns.
+        filters: row filters pushed down to the Parquet reader, eg. [('chunk', 'in', [1, 2]), ('Status', '==', 'Active')].
+        memory_map: map the file instead of reading it into a buffer first.
+        UBI numbers in `filters` should be normalized, see normalize_ubi.
+    """
+    return pd.read_parquet(path, columns=columns, filters=filters, memory_map=memory_map)